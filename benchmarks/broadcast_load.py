@@ -0,0 +1,179 @@
+"""
+Offline load test for the broadcast fan-out path.
+
+Starts a local aiohttp server that imitates Discord's webhook execute endpoint
+(latency, 429s with ``retry_after`` and 404s for deleted webhooks), fills an
+in-memory channel registry and broadcasts to every channel through
+:class:`broadcast.Broadcaster`.
+
+Run from the repository root::
+
+    python -m benchmarks.broadcast_load --guilds 10000 --latency 0.05
+"""
+from aiohttp import web
+from typing import List, Set
+import aiohttp
+import asyncio
+import click
+import discord
+import logging
+import random
+import time
+import broadcast
+import storage
+
+
+class FakeDiscord:
+    def __init__(
+        self,
+        *,
+        latency: float,
+        jitter: float,
+        ratelimit_rate: float,
+        retry_after: float,
+        dead: Set[int],
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.ratelimit_rate = ratelimit_rate
+        self.retry_after = retry_after
+        self.dead = dead
+        self.requests = 0
+        self.ratelimited = 0
+        self.not_found = 0
+
+    async def execute(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await request.read()
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(0, self.jitter)))
+        if int(request.match_info["webhook"]) in self.dead:
+            self.not_found += 1
+            return web.json_response(
+                {"message": "Unknown Webhook", "code": 10015}, status=404
+            )
+        if random.random() < self.ratelimit_rate:
+            self.ratelimited += 1
+            return web.json_response(
+                {
+                    "message": "You are being rate limited.",
+                    "retry_after": self.retry_after,
+                    "global": False,
+                },
+                status=429,
+                headers={
+                    "Retry-After": str(self.retry_after),
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset-After": str(self.retry_after),
+                },
+            )
+        return web.Response(
+            status=204,
+            headers={"X-RateLimit-Remaining": "4", "X-RateLimit-Reset-After": "2"},
+        )
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/webhooks/{webhook}/{token}", self.execute)
+        app.router.add_get("/api/webhooks/{webhook}/{token}", self.execute)
+        return app
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def _run(
+    guilds: int,
+    latency: float,
+    jitter: float,
+    ratelimit_rate: float,
+    retry_after: float,
+    dead_rate: float,
+    concurrency: int,
+    retries: int,
+) -> None:
+    registry = storage.ChannelRegistry()
+    for guild in range(1, guilds + 1):
+        registry.add(storage.Channel(guild, 0, guild, guild, f"token-{guild}"))
+    channels = registry.of_type(0)
+    dead = {i.webhook for i in channels if random.random() < dead_rate}
+
+    fake = FakeDiscord(
+        latency=latency,
+        jitter=jitter,
+        ratelimit_rate=ratelimit_rate,
+        retry_after=retry_after,
+        dead=dead,
+    )
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    latencies: List[float] = []
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        latencies.append(time.perf_counter() - context.start)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+
+    embed = discord.Embed(title="Load test", description="x" * 512)
+    payload = broadcast.WebhookPayload.build(
+        "https://youtu.be/dQw4w9WgXcQ",
+        embed=embed,
+        username="GrowTube News",
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, trace_configs=[trace]
+        ) as session:
+            broadcaster = broadcast.Broadcaster(
+                session,
+                base_url=f"http://127.0.0.1:{port}/api",
+                max_concurrency=concurrency,
+                max_retries=retries,
+                backoff=0.05,
+            )
+            report = await broadcaster.broadcast(channels, payload)
+    finally:
+        await runner.cleanup()
+
+    click.echo(f"targets:     {len(channels)} ({len(dead)} dead)")
+    click.echo(f"report:      {report}")
+    click.echo(f"dead:        {len(report.dead)}")
+    click.echo(f"throughput:  {report.sent / report.elapsed:,.1f} deliveries/s")
+    click.echo(f"requests:    {fake.requests} ({fake.ratelimited} rate limited)")
+    click.echo(
+        f"latency:     p50 {_percentile(latencies, 50) * 1000:.1f}ms, "
+        f"p99 {_percentile(latencies, 99) * 1000:.1f}ms"
+    )
+
+
+@click.command()
+@click.option("--guilds", "-g", type=int, default=10000)
+@click.option("--latency", type=float, default=0.05, help="Base response latency")
+@click.option("--jitter", type=float, default=0.02, help="Added random latency")
+@click.option("--ratelimit-rate", type=float, default=0.01, help="Chance of a 429")
+@click.option("--retry-after", type=float, default=0.5)
+@click.option("--dead-rate", type=float, default=0.01, help="Share of 404 webhooks")
+@click.option("--concurrency", "-c", type=int, default=50)
+@click.option("--retries", type=int, default=3)
+def main(**options):
+    logging.getLogger("broadcast").setLevel(logging.ERROR)
+    asyncio.run(_run(**options))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from typing import Optional
 from discord.ext import commands
 from discord.utils import utcnow
 import aioredis
@@ -7,6 +8,8 @@ import discord
 import logs
 import logging
 import storage
+import broadcast
+import conversation
 import os
 import json
 import asyncio
@@ -35,9 +38,21 @@ class GrowTube(commands.Bot):
             )
         )
         self.pool = asyncpg.create_pool(options.pop("dsn"))
-        self.db = storage.PostgresStorage(self.pool)
         self.redis = aioredis.from_url(options.pop("redis"))
+        self.db = storage.PostgresStorage(self.pool, self.redis)
         self.CHANNEL_LOG = options.pop("channel_log", None)
+        self.BROADCAST_WORKER = options.pop("broadcast_worker", True)
+        self.MARKET_TICKER_INTERVAL = options.pop("market_ticker_interval", 5.0)
+        self.REDIS_USER_LOCKS = options.pop("redis_user_locks", False)
+        self.MARKET_DECAY_RATE = options.pop("market_decay_rate", 0.1)
+        self.MARKET_DECAY_INTERVAL = options.pop("market_decay_interval", 3600)
+        self.TRADE_SESSION_TTL = options.pop("trade_session_ttl", 900)
+        self.BROADCAST_CONSUMER = options.pop("broadcast_consumer", None)
+        # set in start(), close() may run before they exist
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        self.broadcast_queue: Optional[broadcast.BroadcastQueue] = None
+        self.conversations = conversation.ConversationRouter()
+        self.add_listener(self.conversations.dispatch, "on_message")
         self.log = logging.getLogger(__name__)
         self.log.setLevel(logging.DEBUG if debug else logging.INFO)
         self.log.addHandler(sh)
@@ -45,19 +60,37 @@ class GrowTube(commands.Bot):
     async def start(self, *args, **kwargs):
         await self.pool
         await self.redis
+        await self.db.connect()
         self.http_session = aiohttp.ClientSession()
+        self.broadcaster = broadcast.Broadcaster(self.http_session)
+        self.janitor = broadcast.WebhookJanitor(self.redis, self.db)
+        self.broadcast_queue = broadcast.BroadcastQueue(
+            self.redis,
+            self.broadcaster,
+            janitor=self.janitor,
+            consumer=self.BROADCAST_CONSUMER,
+        )
+        await self.broadcast_queue.setup()
+        if self.BROADCAST_WORKER:
+            self.broadcast_queue.start()
         self.uptime = utcnow()
         await super().start(*args, **kwargs)
 
     async def close(self):
         self.log.info("Logging out now")
-        results = await asyncio.gather(
-            self.pool.close(),
-            self.redis.close(),
-            self.http_session.close(),
-            super().close(),
-            return_exceptions=True,
-        )
+        market = self.get_cog("Market")
+        if market is not None:
+            try:
+                await market.flush()
+            except Exception:
+                self.log.exception("Failed to flush the market before closing")
+        self.db.close()
+        if self.broadcast_queue is not None:
+            self.broadcast_queue.close()
+        closing = [self.pool.close(), self.redis.close(), super().close()]
+        if self.http_session is not None:
+            closing.append(self.http_session.close())
+        results = await asyncio.gather(*closing, return_exceptions=True)
         for res in results:
             if isinstance(res, BaseException):
                 self.log.exception(
@@ -102,6 +135,13 @@ def get_bot(use_colour: bool = True):
         dsn=config["dsn"],
         redis=config["redis"],
         channel_log=config["channel_log"],
+        broadcast_worker=config.get("broadcast_worker", True),
+        market_ticker_interval=config.get("market_ticker_interval", 5.0),
+        redis_user_locks=config.get("redis_user_locks", False),
+        market_decay_rate=config.get("market_decay_rate", 0.1),
+        market_decay_interval=config.get("market_decay_interval", 3600),
+        trade_session_ttl=config.get("trade_session_ttl", 900),
+        broadcast_consumer=config.get("broadcast_consumer"),
         debug=config.get("debug", False),
         use_colour=use_colour,
         intents=intents,
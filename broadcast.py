@@ -0,0 +1,609 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from discord.http import Route
+from secrets import token_hex
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import time
+import aiohttp
+import discord
+import storage
+
+log = logging.getLogger(__name__)
+
+API_BASE = Route.BASE
+STREAM = "broadcast:deliveries"
+GROUP = "broadcast-workers"
+JOB_KEY = "broadcast:job:{}"
+JOB_TTL = 60 * 60 * 24
+STRIKES_KEY = "broadcast:strikes"
+DEAD_STATUSES = frozenset({401, 404})
+
+
+def build_payload(
+    content: Optional[str] = None,
+    *,
+    username: Optional[str] = None,
+    avatar_url: Optional[str] = None,
+    embed: Optional[discord.Embed] = None,
+    embeds: Optional[List[discord.Embed]] = None,
+    allowed_mentions: Optional[discord.AllowedMentions] = None,
+) -> Dict[str, Any]:
+    """
+    Builds the json body of a webhook execute request
+    """
+    payload: Dict[str, Any] = {}
+    if content is not None:
+        payload["content"] = str(content)
+    if embed is not None:
+        embeds = [embed, *(embeds or ())]
+    if embeds:
+        payload["embeds"] = [i.to_dict() for i in embeds]
+    if username is not None:
+        payload["username"] = username
+    if avatar_url is not None:
+        payload["avatar_url"] = str(avatar_url)
+    if allowed_mentions is not None:
+        payload["allowed_mentions"] = allowed_mentions.to_dict()
+    return payload
+
+
+class WebhookPayload:
+    """
+    A webhook execute request, encoded once and posted as-is to every target.
+
+    Content, embeds and files all go out in a single request, files are sent
+    as multipart form data next to the already encoded ``payload_json``.
+    """
+
+    __slots__ = ("body", "files")
+
+    def __init__(self, body: bytes, files: Sequence[Tuple[str, bytes]] = ()) -> None:
+        self.body = body
+        self.files = tuple(files)
+
+    def request(self) -> Tuple[Any, Dict[str, str]]:
+        """
+        Returns the request data and headers, only the form wrapper is rebuilt
+        """
+        if not self.files:
+            return self.body, {"Content-Type": "application/json"}
+        form = aiohttp.FormData()
+        form.add_field("payload_json", self.body, content_type="application/json")
+        for index, (filename, data) in enumerate(self.files):
+            form.add_field(
+                f"files[{index}]",
+                data,
+                filename=filename,
+                content_type="application/octet-stream",
+            )
+        return form, {}
+
+    def to_fields(self) -> Dict[str, bytes]:
+        fields = {"body": self.body, "files": str(len(self.files)).encode()}
+        for index, (filename, data) in enumerate(self.files):
+            fields[f"file:{index}:name"] = filename.encode()
+            fields[f"file:{index}:data"] = data
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields: Dict[bytes, bytes]) -> "WebhookPayload":
+        files = [
+            (
+                fields[f"file:{index}:name".encode()].decode(),
+                fields[f"file:{index}:data".encode()],
+            )
+            for index in range(int(fields.get(b"files", 0)))
+        ]
+        return cls(fields[b"body"], files)
+
+    @classmethod
+    def build(
+        cls,
+        content: Optional[str] = None,
+        *,
+        files: Sequence[discord.File] = (),
+        **fields: Any,
+    ) -> "WebhookPayload":
+        payload = build_payload(content, **fields)
+        attachments = []
+        for index, file in enumerate(files):
+            attachments.append((file.filename, file.fp.read()))
+            file.close()
+        if attachments:
+            payload["attachments"] = [
+                {"id": index, "filename": filename}
+                for index, (filename, _) in enumerate(attachments)
+            ]
+        return cls(json.dumps(payload, separators=(",", ":")).encode(), attachments)
+
+
+@dataclass
+class DeliveryReport:
+    sent: int = 0
+    retried: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    failures: List[Tuple[storage.Channel, str]] = field(default_factory=list)
+    delivered: List[int] = field(default_factory=list)
+    dead: List[storage.Channel] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            f"sent {self.sent}, retried {self.retried}, "
+            f"failed {self.failed} in {self.elapsed:.2f}s"
+        )
+
+
+class _Bucket:
+    __slots__ = ("remaining", "reset_at")
+
+    def __init__(self) -> None:
+        self.remaining = 1
+        self.reset_at = 0.0
+
+    def delay(self, now: float) -> float:
+        if now >= self.reset_at or self.remaining > 0:
+            return 0.0
+        return self.reset_at - now
+
+    def update(self, headers, now: float) -> None:
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = now + float(reset_after)
+
+
+class Broadcaster:
+    """
+    Sends a message to many webhooks at once.
+
+    At most ``max_concurrency`` requests are in flight, each webhook's rate
+    limit bucket and the global rate limit are respected, and failed requests
+    (429, 5xx and connection errors) are retried with jittered backoff.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        *,
+        base_url: str = API_BASE,
+        max_concurrency: int = 50,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ) -> None:
+        self._session = session
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._buckets: Dict[int, _Bucket] = {}
+        self._global_until = 0.0
+
+    async def broadcast(
+        self, channels: Iterable[storage.Channel], payload: WebhookPayload
+    ) -> DeliveryReport:
+        report = DeliveryReport()
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(self._deliver(channel, payload, report) for channel in channels)
+        )
+        report.elapsed = time.perf_counter() - start
+        if report.failures:
+            log.warning(
+                "Broadcast %s, failed webhooks: %s",
+                report,
+                ", ".join(f"{c.webhook} ({reason})" for c, reason in report.failures),
+            )
+        return report
+
+    def _jitter(self, delay: float) -> float:
+        return delay + random.uniform(0, self.backoff)
+
+    async def _deliver(
+        self,
+        channel: storage.Channel,
+        payload: WebhookPayload,
+        report: DeliveryReport,
+    ) -> None:
+        status, reason = await self._attempt(channel, payload, report)
+        if status is not None and status < 300:
+            report.sent += 1
+            report.delivered.append(channel.webhook)
+            return
+        if status in DEAD_STATUSES:
+            report.dead.append(channel)
+        report.failed += 1
+        report.failures.append((channel, reason))
+
+    async def _attempt(
+        self,
+        channel: storage.Channel,
+        payload: Optional[WebhookPayload],
+        report: Optional[DeliveryReport] = None,
+    ) -> Tuple[Optional[int], str]:
+        """
+        Requests until success, a non retryable status or ``max_retries``, returns
+        the last status (None for connection errors) and the failure reason
+        """
+        status = None
+        reason = "unknown"
+        for attempt in range(self.max_retries + 1):
+            if attempt and report is not None:
+                report.retried += 1
+            try:
+                async with self._semaphore:
+                    status, retry_after = await self._request(channel, payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                status = None
+                reason = repr(exc)
+                delay = self._jitter(self.backoff * 2**attempt)
+            else:
+                if status < 300:
+                    return status, "ok"
+                reason = f"HTTP {status}"
+                if status == 429:
+                    delay = self._jitter(retry_after)
+                elif status >= 500:
+                    delay = self._jitter(self.backoff * 2**attempt)
+                else:
+                    break
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        return status, reason
+
+    async def validate(
+        self,
+        channels: Iterable[storage.Channel],
+        *,
+        batch_size: int = 50,
+        interval: float = 1.0,
+    ) -> List[storage.Channel]:
+        """
+        Fetches every webhook in batches of ``batch_size``, sleeping ``interval``
+        seconds between batches, returns the channels whose webhook is gone
+        """
+        channels = list(channels)
+        dead = []
+        for index in range(0, len(channels), batch_size):
+            batch = channels[index : index + batch_size]
+            results = await asyncio.gather(*(self._attempt(i, None) for i in batch))
+            dead.extend(
+                channel
+                for channel, (status, _) in zip(batch, results)
+                if status in DEAD_STATUSES
+            )
+            await asyncio.sleep(interval)
+        return dead
+
+    async def _wait(self, bucket: _Bucket) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            delay = max(self._global_until - now, bucket.delay(now))
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if now < bucket.reset_at:
+            bucket.remaining -= 1
+
+    async def _request(
+        self, channel: storage.Channel, payload: Optional[WebhookPayload]
+    ) -> Tuple[int, float]:
+        loop = asyncio.get_running_loop()
+        bucket = self._buckets.setdefault(channel.webhook, _Bucket())
+        await self._wait(bucket)
+        url = f"{self.base_url}/webhooks/{channel.webhook}/{channel.token}"
+        if payload is None:
+            request = self._session.get(url)
+        else:
+            data, headers = payload.request()
+            request = self._session.post(url, data=data, headers=headers)
+        async with request as resp:
+            bucket.update(resp.headers, loop.time())
+            if resp.status != 429:
+                return resp.status, 0.0
+            try:
+                data = await resp.json(content_type=None) or {}
+            except ValueError:
+                data = {}
+            retry_after = float(
+                data.get("retry_after", resp.headers.get("Retry-After", 1))
+            )
+            if data.get("global") or resp.headers.get("X-RateLimit-Global"):
+                self._global_until = loop.time() + retry_after
+            return 429, retry_after
+
+
+class WebhookJanitor:
+    """
+    Counts 401/404 responses per webhook in redis and removes the channel once
+    its webhook fails ``threshold`` broadcasts in a row
+    """
+
+    def __init__(
+        self, redis, storage: storage.PostgresStorage, *, threshold: int = 3
+    ) -> None:
+        self._redis = redis
+        self._storage = storage
+        self.threshold = threshold
+
+    async def record(self, report: DeliveryReport) -> List[storage.Channel]:
+        """
+        Records a broadcast's dead and delivered webhooks, returns the pruned channels
+        """
+        recovered = set()
+        if report.delivered:
+            struck = {int(i) for i in await self._redis.hkeys(STRIKES_KEY)}
+            recovered = struck.intersection(report.delivered)
+        if not report.dead and not recovered:
+            return []
+        pipe = self._redis.pipeline(transaction=False)
+        for channel in report.dead:
+            pipe.hincrby(STRIKES_KEY, channel.webhook, 1)
+        if recovered:
+            pipe.hdel(STRIKES_KEY, *recovered)
+        strikes = await pipe.execute()
+        pruned = [
+            channel
+            for channel, count in zip(report.dead, strikes)
+            if count >= self.threshold
+        ]
+        await self.prune(pruned)
+        return pruned
+
+    async def prune(self, channels: List[storage.Channel]) -> None:
+        removed = 0
+        for channel in channels:
+            # the guild may have set up a new webhook since this one died
+            removed += await self._storage.remove_webhook(channel)
+        if channels:
+            await self._redis.hdel(STRIKES_KEY, *(i.webhook for i in channels))
+            log.info("Pruned %d dead webhooks", removed)
+
+
+def _decode(fields: Dict[bytes, bytes]) -> Dict[str, str]:
+    return {k.decode(): v.decode() for k, v in fields.items()}
+
+
+class BroadcastQueue:
+    """
+    Durable broadcast queue backed by a redis stream.
+
+    :meth:`enqueue` stores the payload once under a job key and adds one stream
+    entry per target webhook. Workers read the stream through a consumer group,
+    so entries are only acknowledged after delivery and entries left pending by
+    a crashed worker are claimed by another one once they're ``claim_idle``
+    milliseconds old. Delivery is at-least-once.
+    """
+
+    def __init__(
+        self,
+        redis,
+        broadcaster: Broadcaster,
+        *,
+        janitor: Optional[WebhookJanitor] = None,
+        consumer: Optional[str] = None,
+        batch_size: int = 100,
+        claim_idle: int = 60000,
+        consumer_idle: int = 24 * 60 * 60 * 1000,
+    ) -> None:
+        self._redis = redis
+        self._broadcaster = broadcaster
+        self._janitor = janitor
+        # unique per process, a bot and a worker on the same host must not
+        # replay each other's pending entries. Without a configured name a
+        # restarted process can't resume its own entries, they are claimed
+        # by another consumer after claim_idle instead
+        self.consumer = consumer or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.claim_idle = claim_idle
+        self.consumer_idle = consumer_idle
+        self._payloads: Dict[str, Optional[WebhookPayload]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def setup(self) -> None:
+        try:
+            await self._redis.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+        except Exception as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    async def enqueue(
+        self, channels: Iterable[storage.Channel], payload: WebhookPayload
+    ) -> Tuple[str, int]:
+        """
+        Queues ``payload`` for every channel, returns the job id and the number of
+        queued deliveries
+        """
+        channels = list(channels)
+        job = token_hex(8)
+        key = JOB_KEY.format(job)
+        fields = {
+            **payload.to_fields(),
+            "total": len(channels),
+            "remaining": len(channels),
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "created": time.time(),
+        }
+        if not channels:
+            fields["finished"] = fields["created"]
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, JOB_TTL)
+        for channel in channels:
+            pipe.xadd(
+                STREAM,
+                {
+                    "job": job,
+                    "guild": channel.guild,
+                    "type": channel.type,
+                    "channel": channel.channel,
+                    "webhook": channel.webhook,
+                    "token": channel.token,
+                },
+            )
+        await pipe.execute()
+        return job, len(channels)
+
+    async def report(self, job: str) -> Optional[DeliveryReport]:
+        """
+        Returns the job's report, or None if it's still being delivered
+        """
+        # the job hash also holds the payload, only fetch the counters
+        sent, retried, failed, created, finished = await self._redis.hmget(
+            JOB_KEY.format(job), "sent", "retried", "failed", "created", "finished"
+        )
+        if finished is None:
+            return None
+        return DeliveryReport(
+            sent=int(sent),
+            retried=int(retried),
+            failed=int(failed),
+            elapsed=float(finished) - float(created),
+        )
+
+    async def wait(
+        self, job: str, *, interval: float = 1.0, timeout: Optional[float] = None
+    ) -> DeliveryReport:
+        """
+        Waits for the job's report, raises :class:`asyncio.TimeoutError` if it
+        isn't delivered within ``timeout`` seconds
+        """
+        return await asyncio.wait_for(self._wait(job, interval), timeout)
+
+    async def _wait(self, job: str, interval: float) -> DeliveryReport:
+        while (report := await self.report(job)) is None:
+            await asyncio.sleep(interval)
+        return report
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self) -> None:
+        ready = False
+        last_claim = 0.0
+        while True:
+            try:
+                if not ready:
+                    await self.setup()
+                    # entries this consumer read before a restart but never acknowledged
+                    await self._consume("0")
+                    ready = True
+                if time.monotonic() - last_claim > self.claim_idle / 1000:
+                    last_claim = time.monotonic()
+                    await self._claim()
+                    await self._prune_consumers()
+                await self._consume(">", block=5000)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Broadcast worker failed, retrying")
+                await asyncio.sleep(5)
+
+    async def _consume(self, last_id: str, *, block: Optional[int] = None) -> None:
+        while True:
+            response = await self._redis.xreadgroup(
+                GROUP,
+                self.consumer,
+                {STREAM: last_id},
+                count=self.batch_size,
+                block=block,
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                return
+            await self._process(entries)
+            if last_id == ">":
+                return
+
+    async def _claim(self) -> None:
+        pending = await self._redis.xpending_range(
+            STREAM, GROUP, "-", "+", self.batch_size
+        )
+        stale = [
+            i["message_id"]
+            for i in pending
+            if i["time_since_delivered"] >= self.claim_idle
+        ]
+        if stale:
+            entries = await self._redis.xclaim(
+                STREAM, GROUP, self.consumer, self.claim_idle, stale
+            )
+            await self._process([i for i in entries if i[1]])
+
+    async def _prune_consumers(self) -> None:
+        """
+        Deletes consumers left behind by stopped processes, only ones without
+        pending entries so nothing is lost
+        """
+        for consumer in await self._redis.xinfo_consumers(STREAM, GROUP):
+            if consumer["pending"] or consumer["idle"] < self.consumer_idle:
+                continue
+            name = consumer["name"]
+            await self._redis.xgroup_delconsumer(STREAM, GROUP, name)
+            log.info("Deleted idle broadcast consumer %s", name)
+
+    async def _payload(self, job: str) -> Optional[WebhookPayload]:
+        if job not in self._payloads:
+            if len(self._payloads) > 32:
+                self._payloads.clear()
+            fields = await self._redis.hgetall(JOB_KEY.format(job))
+            self._payloads[job] = WebhookPayload.from_fields(fields) if fields else None
+        return self._payloads[job]
+
+    async def _process(self, entries: List[Tuple[bytes, Dict[bytes, bytes]]]) -> None:
+        jobs: Dict[str, List[Tuple[bytes, storage.Channel]]] = {}
+        for entry_id, fields in entries:
+            fields = _decode(fields)
+            channel = storage.Channel(
+                int(fields["guild"]),
+                int(fields["type"]),
+                int(fields["channel"]),
+                int(fields["webhook"]),
+                fields["token"],
+            )
+            jobs.setdefault(fields["job"], []).append((entry_id, channel))
+
+        for job, targets in jobs.items():
+            ids = [i[0] for i in targets]
+            payload = await self._payload(job)
+            pipe = self._redis.pipeline(transaction=True)
+            if payload is None:
+                log.warning("Dropping %d deliveries of expired job %s", len(ids), job)
+            else:
+                report = await self._broadcaster.broadcast(
+                    [i[1] for i in targets], payload
+                )
+                if self._janitor is not None:
+                    # the webhooks were already sent, failing here would
+                    # leave the entries pending and deliver them again
+                    try:
+                        await self._janitor.record(report)
+                    except Exception:
+                        log.exception("Failed to record dead webhooks of job %s", job)
+                key = JOB_KEY.format(job)
+                pipe.hincrby(key, "sent", report.sent)
+                pipe.hincrby(key, "retried", report.retried)
+                pipe.hincrby(key, "failed", report.failed)
+                pipe.hincrby(key, "remaining", -len(ids))
+            pipe.xack(STREAM, GROUP, *ids)
+            pipe.xdel(STREAM, *ids)
+            results = await pipe.execute()
+            if payload is not None and results[3] <= 0:
+                await self._redis.hset(JOB_KEY.format(job), "finished", time.time())
+                log.info("Broadcast job %s delivered", job)
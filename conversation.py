@@ -0,0 +1,59 @@
+from typing import Dict, Optional, Tuple
+import asyncio
+import discord
+
+ConversationKey = Tuple[int, int]
+
+
+class ConversationCancelled(Exception):
+    pass
+
+
+class ConversationRouter:
+    """
+    Routes incoming messages to pending prompts keyed by (channel id, author id).
+
+    Unlike ``bot.wait_for("message", check=...)`` no check is evaluated per
+    pending prompt, dispatching a message is a single dict lookup. A key only
+    has one pending prompt, waiting again on the same key cancels the older one.
+    """
+
+    def __init__(self) -> None:
+        self._pending: Dict[ConversationKey, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def __contains__(self, key: ConversationKey) -> bool:
+        return key in self._pending
+
+    async def dispatch(self, message: discord.Message) -> None:
+        future = self._pending.pop((message.channel.id, message.author.id), None)
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    async def wait(
+        self, channel_id: int, author_id: int, *, timeout: Optional[float] = None
+    ) -> discord.Message:
+        """
+        Waits for the next message from ``author_id`` in ``channel_id``
+
+        Raises :exc:`asyncio.TimeoutError` after ``timeout`` seconds and
+        :exc:`ConversationCancelled` if the prompt is cancelled or replaced.
+        """
+        key = (channel_id, author_id)
+        self.cancel(channel_id, author_id)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def cancel(self, channel_id: int, author_id: int) -> bool:
+        future = self._pending.pop((channel_id, author_id), None)
+        if future is None or future.done():
+            return False
+        future.set_exception(ConversationCancelled())
+        return True
@@ -2,7 +2,10 @@ from typing import Dict, Optional, Tuple, Callable
 from discord.ext.commands.errors import NoPrivateMessage
 from discord import Embed, Color, TextChannel, utils, Webhook
 from bot import GrowTube, NotPermittedForPublish, GrowContext
-from discord.ext import commands
+from broadcast import DeliveryReport, WebhookPayload
+from conversation import ConversationCancelled
+from discord.ext import commands, tasks
+from io import BytesIO
 import discord
 import datetime
 import asyncio
@@ -66,6 +69,10 @@ server_status: Dict[str, Tuple[str, str, Color]] = {
 
 color = discord.ButtonStyle.gray
 
+PROMPT_TIMEOUT = 300
+# how long a publish command waits for the delivery report
+BROADCAST_WAIT_TIMEOUT = 300
+
 
 class QuitError(Exception):
     def __init__(self, msg=None, message=None):
@@ -75,19 +82,31 @@ class QuitError(Exception):
     def __str__(self):
         return self.msg
 
+    async def respond(self, ctx: GrowContext):
+        if self.message is None:
+            await ctx.send(self.msg)
+        else:
+            await self.message.add_reaction("✅")
+
 
 async def message_wait(
     ctx: GrowContext,
     predicate: Callable[[discord.Message], bool],
     input,
     msg="Invalid value!",
+    *,
+    timeout: Optional[float] = PROMPT_TIMEOUT,
 ) -> discord.Message:
     await ctx.send(input + ". Enter `cancel` to exit.")
     while True:
-        message = await ctx.bot.wait_for(
-            "message",
-            check=lambda x: x.author == ctx.author and x.channel == ctx.channel,
-        )
+        try:
+            message = await ctx.bot.conversations.wait(
+                ctx.channel.id, ctx.author.id, timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            raise QuitError("I waited for too long!")
+        except ConversationCancelled:
+            raise QuitError("Cancelled!")
         if message.content.lower() == "cancel":
             raise QuitError(message=message)
         elif predicate is None or predicate(message):
@@ -96,29 +115,26 @@ async def message_wait(
             await ctx.send(msg)
 
 
-async def broadcast(chtype: int, ctx: GrowContext, *args, **kwargs):
+async def broadcast(
+    chtype: int, ctx: GrowContext, content: Optional[str] = None, **kwargs
+) -> Optional[DeliveryReport]:
     bot = ctx.bot
+    payload = WebhookPayload.build(
+        content,
+        username=bot.user.name,
+        avatar_url=bot.user.display_avatar.url,
+        allowed_mentions=discord.AllowedMentions.none(),
+        **kwargs,
+    )
     channels = await bot.db.get_channels(chtype)
-
-    async def _send(channel):
-        try:
-            webhook = Webhook.partial(
-                channel.webhook, channel.token, session=bot.http_session
-            )
-            await webhook.send(
-                username=bot.user.name,
-                avatar_url=bot.user.avatar.url,
-                allowed_mentions=discord.AllowedMentions.none(),
-                *args,
-                **kwargs,
-            )
-        except Exception as e:
-            print(repr(e))
-
-    tasks = [asyncio.create_task(_send(i)) for i in channels]
-    if not tasks:
-        return
-    return await asyncio.wait(tasks)
+    job, count = await bot.broadcast_queue.enqueue(channels, payload)
+    await ctx.send(f"Queued broadcast `{job}` for {count} channels")
+    try:
+        return await bot.broadcast_queue.wait(job, timeout=BROADCAST_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        await ctx.send(
+            f"Broadcast `{job}` is still being delivered, is a broadcast worker running?"
+        )
 
 
 def get_time():
@@ -229,6 +245,35 @@ class Articles(commands.Cog):
 
     def __init__(self, bot: GrowTube) -> None:
         self.bot = bot
+        self.sweep_webhooks.start()
+
+    def cog_unload(self):
+        self.sweep_webhooks.cancel()
+
+    @tasks.loop(hours=12)
+    async def sweep_webhooks(self):
+        channels = []
+        for chtype in _channel_dict:
+            channels.extend(await self.bot.db.get_channels(chtype))
+        dead = await self.bot.broadcaster.validate(channels)
+        if not dead:
+            return
+        await self.bot.janitor.prune(dead)
+        log_channel = self.bot.get_channel(self.bot.CHANNEL_LOG)
+        if log_channel:
+            removed = "\n".join(
+                f"guild: {i.guild}, type: {_channel_dict.get(i.type, i.type)}, "
+                f"channel: {i.channel}, webhook: {i.webhook}"
+                for i in dead
+            )
+            await log_channel.send(
+                f"Removed **{len(dead)}** dead webhooks",
+                file=discord.File(BytesIO(removed.encode()), "webhooks.txt"),
+            )
+
+    @sweep_webhooks.before_loop
+    async def before_sweep_webhooks(self):
+        await self.bot.wait_until_ready()
 
     @commands.command()
     @commands.check(check)
@@ -244,7 +289,7 @@ class Articles(commands.Cog):
         try:
             msg = await message_wait(ctx, None, "Insert a description")
         except QuitError as e:
-            return await e.message.add_reaction("✅")
+            return await e.respond(ctx)
         stype = stype[1]
         embed = Embed(
             color=stype[2],
@@ -260,7 +305,9 @@ class Articles(commands.Cog):
         embed.set_footer(
             text=f"Growtube News | Published by {ctx.author}", icon_url=emoji_url
         )
-        await broadcast(Channel.category1, ctx, embed=embed)
+        report = await broadcast(Channel.category1, ctx, embed=embed)
+        if report is not None:
+            await ctx.send(f"Broadcast {report}")
 
     @commands.group(invoke_without_command=True)
     @commands.check(check_channel)
@@ -392,7 +439,7 @@ class Articles(commands.Cog):
                 content = content.content
 
         except QuitError as e:
-            await e.message.add_reaction("✅")
+            await e.respond(ctx)
             return
 
         embed = Embed(
@@ -410,23 +457,26 @@ class Articles(commands.Cog):
         if image:
             embed.set_image(url=image)
 
-        tasks = [ctx.send(embed=embed)]
-        if content:
-            tasks.append(ctx.send(content))
-        await asyncio.gather(*tasks, ctx.send("Are you sure? (`yes, y, no, n`)"))
-        confirmation = await self.bot.wait_for(
-            "message",
-            check=lambda x: x.author == ctx.author
-            and ctx.channel == x.channel
-            and x.content.lower() in {"yes", "y", "no", "n"},
-        )
+        await ctx.send(content, embed=embed)
+        try:
+            confirmation = await message_wait(
+                ctx,
+                lambda x: x.content.lower() in {"yes", "y", "no", "n"},
+                "Are you sure? (`yes, y, no, n`)",
+                "Invalid answer!",
+            )
+        except QuitError as e:
+            await e.respond(ctx)
+            return
         if confirmation.content.lower().startswith("n"):
             await ctx.send("Cancelled!")
             return
-        tasks = [broadcast(chtype, ctx, embed=embed)]
-        if content:
-            tasks.append(broadcast(chtype, ctx, content))
-        await asyncio.gather(*tasks, confirmation.add_reaction("✅"))
+        report, _ = await asyncio.gather(
+            broadcast(chtype, ctx, content, embed=embed),
+            confirmation.add_reaction("✅"),
+        )
+        if report is not None:
+            await ctx.send(f"Broadcast {report}")
 
 
 def setup(bot: GrowTube):
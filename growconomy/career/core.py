@@ -5,6 +5,7 @@ from discord.ext import commands
 from bot import GrowContext, GrowTube, MessagedError
 from growconomy.constants import currency_name, embed_color, currency_emoji
 from growconomy.views import ConfirmView
+from growconomy.users import registration_check
 
 
 class Career(commands.Cog):
@@ -12,12 +13,7 @@ class Career(commands.Cog):
         self.bot = bot
 
     async def cog_check(self, ctx: GrowContext):
-        data = await self.bot.pool.fetchval(
-            "SELECT 1 FROM users WHERE id = $1", ctx.author.id
-        )
-        if data is None:
-            raise MessagedError("You're not registered")
-        return True
+        return await registration_check(ctx)
 
     @commands.group(invoke_without_command=True)
     async def career(self, ctx: GrowContext):
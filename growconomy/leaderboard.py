@@ -0,0 +1,143 @@
+from typing import Dict, List, Mapping, Tuple
+from collections import OrderedDict
+from time import monotonic
+from secrets import token_hex
+import asyncio
+import aioredis
+import asyncpg
+import discord
+import logging
+
+LEADERBOARD_KEY = "leaderboard:currency"
+
+log = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """
+    Currency leaderboard kept in a redis sorted set.
+
+    Every currency change adds its delta with ``ZINCRBY`` so reading the top
+    of the board is a single ``ZREVRANGE``. :meth:`rebuild` replaces the set
+    with the balances in postgres, which also repairs drift from lost updates.
+    """
+
+    def __init__(self, key: str = LEADERBOARD_KEY, *, chunk_size: int = 5000) -> None:
+        self.key = key
+        self.chunk_size = chunk_size
+
+    async def add(self, redis: aioredis.Redis, deltas: Mapping[int, int]) -> None:
+        async with redis.pipeline(transaction=False) as pipe:
+            for user_id, delta in deltas.items():
+                if delta:
+                    pipe.zincrby(self.key, delta, user_id)
+            await pipe.execute()
+
+    def record(self, redis: aioredis.Redis, deltas: Mapping[int, int]) -> None:
+        """
+        Schedules :meth:`add` without waiting for it, errors are logged
+        """
+        task = asyncio.create_task(self.add(redis, deltas))
+        task.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Leaderboard update failed", exc_info=task.exception())
+
+    async def top(self, redis: aioredis.Redis, limit: int) -> List[Tuple[int, int]]:
+        records = await redis.zrevrange(self.key, 0, limit - 1, withscores=True)
+        return [(int(user_id), int(score)) for user_id, score in records]
+
+    async def exists(self, redis: aioredis.Redis) -> bool:
+        return bool(await redis.exists(self.key))
+
+    async def rebuild(self, redis: aioredis.Redis, pool: asyncpg.Pool) -> int:
+        """
+        Replaces the leaderboard with the balances in postgres
+
+        Balances are written to a temporary key that is renamed over the
+        leaderboard, so readers never see a partial board.
+        """
+        temp = f"{self.key}:rebuild:{token_hex(4)}"
+        count = 0
+        try:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    chunk: Dict[int, int] = {}
+                    async for record in conn.cursor(
+                        "SELECT id, currency FROM users", prefetch=self.chunk_size
+                    ):
+                        chunk[record["id"]] = record["currency"]
+                        if len(chunk) >= self.chunk_size:
+                            await redis.zadd(temp, chunk)
+                            count += len(chunk)
+                            chunk = {}
+                    if chunk:
+                        await redis.zadd(temp, chunk)
+                        count += len(chunk)
+            if count:
+                await redis.rename(temp, self.key)
+            else:
+                await redis.delete(self.key)
+        finally:
+            await redis.delete(temp)
+        return count
+
+
+class UserNames:
+    """
+    LRU cache of user names for users the bot may not have cached.
+
+    Names missing from both the bot cache and this cache are fetched
+    concurrently, ``ttl`` seconds later they are fetched again.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600.0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # user id -> (name, expiry)
+        self._cache: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _set(self, user_id: int, name: str) -> None:
+        self._cache[user_id] = (name, monotonic() + self.ttl)
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def _fetch(self, client: discord.Client, user_id: int) -> None:
+        try:
+            user = await client.fetch_user(user_id)
+        except discord.NotFound:
+            self._set(user_id, "Deleted User")
+        except discord.HTTPException:
+            pass
+        else:
+            self._set(user_id, str(user))
+
+    async def resolve(
+        self, client: discord.Client, user_ids: List[int]
+    ) -> Dict[int, str]:
+        missing = []
+        now = monotonic()
+        for user_id in user_ids:
+            user = client.get_user(user_id)
+            if user is not None:
+                self._set(user_id, str(user))
+                continue
+            entry = self._cache.get(user_id)
+            if entry is None or entry[1] <= now:
+                missing.append(user_id)
+        if missing:
+            await asyncio.gather(*(self._fetch(client, i) for i in missing))
+        return {
+            user_id: self._cache[user_id][0] if user_id in self._cache else str(user_id)
+            for user_id in user_ids
+        }
+
+
+leaderboard = Leaderboard()
+user_names = UserNames()
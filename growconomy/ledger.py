@@ -0,0 +1,114 @@
+from typing import List, Optional, Tuple
+from datetime import datetime, timezone
+from discord.utils import utcnow
+import asyncpg
+
+# ledger kinds
+OPENING = 0
+COLLECT = 1
+BUY = 2
+SELL = 3
+TRANSFER = 4
+TRADE = 5
+
+COLUMNS = ("time", "kind", "user_id", "item_id", "amount", "counterparty")
+
+_CURRENCY_MISMATCH_QUERY = """
+SELECT COALESCE(users.id, ledger.user_id) AS user_id, NULL::bigint AS item_id,
+    COALESCE(users.currency, 0) AS balance, COALESCE(ledger.total, 0) AS ledger
+FROM users FULL JOIN (
+    SELECT user_id, SUM(amount) AS total FROM ledger WHERE item_id IS NULL GROUP BY user_id
+) AS ledger ON ledger.user_id = users.id
+WHERE COALESCE(users.currency, 0) <> COALESCE(ledger.total, 0)
+"""
+
+_ITEM_MISMATCH_QUERY = """
+SELECT COALESCE(inventory.user_id, ledger.user_id) AS user_id,
+    COALESCE(inventory.item_id, ledger.item_id) AS item_id,
+    COALESCE(inventory.quantity, 0) AS balance, COALESCE(ledger.total, 0) AS ledger
+FROM inventory FULL JOIN (
+    SELECT user_id, item_id, SUM(amount) AS total FROM ledger
+    WHERE item_id IS NOT NULL GROUP BY user_id, item_id
+) AS ledger ON ledger.user_id = inventory.user_id AND ledger.item_id = inventory.item_id
+WHERE COALESCE(inventory.quantity, 0) <> COALESCE(ledger.total, 0)
+"""
+
+
+def _month(time: datetime, offset: int = 0) -> datetime:
+    month = time.year * 12 + time.month - 1 + offset
+    return datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+class Ledger:
+    """
+    Append-only record of every currency and item movement.
+
+    Entries are buffered in memory and written with ``COPY`` by :meth:`flush`.
+    An entry with no item id is a currency movement, ``amount`` is signed.
+    The ``ledger`` table is partitioned by month, :meth:`ensure_partitions`
+    creates the partitions ahead of time.
+    """
+
+    def __init__(self) -> None:
+        self._entries: List[Tuple] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(
+        self,
+        kind: int,
+        user_id: int,
+        amount: int,
+        *,
+        item_id: Optional[int] = None,
+        counterparty: Optional[int] = None,
+    ) -> None:
+        if amount:
+            self._entries.append(
+                (utcnow(), kind, user_id, item_id, amount, counterparty)
+            )
+
+    async def flush(self, pool: asyncpg.Pool) -> int:
+        if not self._entries:
+            return 0
+        entries, self._entries = self._entries, []
+        try:
+            async with pool.acquire() as conn:
+                await conn.copy_records_to_table(
+                    "ledger", records=entries, columns=COLUMNS
+                )
+        except Exception:
+            self._entries[:0] = entries
+            raise
+        return len(entries)
+
+    async def ensure_partitions(self, pool: asyncpg.Pool, months: int = 2) -> None:
+        """
+        Creates the partitions of this month and the next ``months`` months
+        """
+        now = utcnow()
+        for offset in range(months + 1):
+            start, end = _month(now, offset), _month(now, offset + 1)
+            await pool.execute(
+                f'CREATE TABLE IF NOT EXISTS "ledger_{start:%Y_%m}" PARTITION OF "ledger" '
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+
+    async def reconcile(self, pool: asyncpg.Pool) -> List[asyncpg.Record]:
+        """
+        Balances that don't match the sum of their ledger entries
+
+        Entries still buffered in other processes show up as mismatches until
+        they are flushed.
+        """
+        await self.flush(pool)
+        async with pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                return [
+                    *await conn.fetch(_CURRENCY_MISMATCH_QUERY),
+                    *await conn.fetch(_ITEM_MISMATCH_QUERY),
+                ]
+
+
+ledger = Ledger()
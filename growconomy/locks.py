@@ -0,0 +1,82 @@
+from typing import AsyncIterator, List, Optional
+from asyncio import Lock
+from contextlib import AsyncExitStack, asynccontextmanager
+from aioredis.exceptions import LockError
+from aioredis.lock import Lock as RedisLock
+from bot import GrowTube, MessagedError
+import aioredis
+import logging
+
+LOCK_KEY = "economy:lock:{}"
+
+log = logging.getLogger(__name__)
+
+
+class UserLocks:
+    """
+    Striped per-user locks that serialize economy writes of the same user.
+
+    Users are hashed onto a fixed number of :class:`asyncio.Lock` so memory
+    doesn't grow with the user base, unrelated users sharing a stripe only
+    wait on each other. When a redis client is passed a redis lock is taken
+    for every user as well, which serializes writes across processes.
+    """
+
+    def __init__(
+        self, stripes: int = 1024, *, ttl: float = 30.0, blocking_timeout: float = 10.0
+    ) -> None:
+        self._locks: List[Optional[Lock]] = [None] * stripes
+        self.ttl = ttl
+        self.blocking_timeout = blocking_timeout
+
+    def _stripe(self, user_id: int) -> int:
+        # the low bits of a snowflake are mostly zero, mix in the timestamp
+        return ((user_id >> 22) ^ user_id) % len(self._locks)
+
+    def _lock(self, stripe: int) -> Lock:
+        lock = self._locks[stripe]
+        if lock is None:
+            lock = self._locks[stripe] = Lock()
+        return lock
+
+    @staticmethod
+    async def _release(lock: RedisLock) -> None:
+        try:
+            await lock.release()
+        except LockError:
+            log.warning(f"Lock {lock.name!r} expired before it was released")
+
+    @asynccontextmanager
+    async def acquire(
+        self, *user_ids: int, redis: Optional[aioredis.Redis] = None
+    ) -> AsyncIterator[None]:
+        """
+        Holds the locks of every user, always taken in the same order so two
+        multi-user acquisitions can't deadlock
+        """
+        async with AsyncExitStack() as stack:
+            for stripe in sorted({self._stripe(i) for i in user_ids}):
+                await stack.enter_async_context(self._lock(stripe))
+            if redis is not None:
+                for user_id in sorted(set(user_ids)):
+                    lock = redis.lock(
+                        LOCK_KEY.format(user_id),
+                        timeout=self.ttl,
+                        blocking_timeout=self.blocking_timeout,
+                    )
+                    if not await lock.acquire():
+                        raise MessagedError("Your previous command is still running")
+                    stack.push_async_callback(self._release, lock)
+            yield
+
+
+user_locks = UserLocks()
+
+
+def user_lock(bot: GrowTube, *user_ids: int):
+    """
+    Locks users with redis locks when ``redis_user_locks`` is enabled
+    """
+    return user_locks.acquire(
+        *user_ids, redis=bot.redis if bot.REDIS_USER_LOCKS else None
+    )
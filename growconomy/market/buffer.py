@@ -0,0 +1,77 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from asyncio import Lock
+import asyncpg
+
+_FLUSH_QUERY = """
+INSERT INTO inventory (item_id, user_id, quantity)
+SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+ON CONFLICT (user_id, item_id) DO UPDATE SET quantity = inventory.quantity + EXCLUDED.quantity
+"""
+
+
+class CollectBuffer:
+    """
+    Write-behind buffer for collected items.
+
+    Collected quantities are added up per user and item in memory and written
+    to ``inventory`` by :meth:`flush` in one upsert. Anything that reads or
+    changes a user's inventory calls :meth:`flush_users` first so buffered
+    items are never missed.
+
+    ``on_write`` is called with the quantities of every successful write.
+    """
+
+    def __init__(
+        self,
+        *,
+        on_write: Optional[Callable[[Dict[int, Dict[int, int]]], Any]] = None,
+    ) -> None:
+        # user id -> item id -> quantity
+        self._pending: Dict[int, Dict[int, int]] = {}
+        self._lock = Lock()
+        self.on_write = on_write
+
+    def __len__(self) -> int:
+        return sum(len(i) for i in self._pending.values())
+
+    def add(self, user_id: int, item_id: int, quantity: int = 1) -> None:
+        items = self._pending.setdefault(user_id, {})
+        items[item_id] = items.get(item_id, 0) + quantity
+
+    async def _write(
+        self, pool: asyncpg.Pool, pending: Dict[int, Dict[int, int]]
+    ) -> int:
+        item_ids: List[int] = []
+        user_ids: List[int] = []
+        quantities: List[int] = []
+        for user_id, items in pending.items():
+            for item_id, quantity in items.items():
+                item_ids.append(item_id)
+                user_ids.append(user_id)
+                quantities.append(quantity)
+        if not item_ids:
+            return 0
+        try:
+            await pool.execute(_FLUSH_QUERY, item_ids, user_ids, quantities)
+        except Exception:
+            for user_id, items in pending.items():
+                for item_id, quantity in items.items():
+                    self.add(user_id, item_id, quantity)
+            raise
+        if self.on_write is not None:
+            self.on_write(pending)
+        return len(item_ids)
+
+    async def flush(self, pool: asyncpg.Pool) -> int:
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            return await self._write(pool, pending)
+
+    async def flush_users(self, pool: asyncpg.Pool, user_ids: Iterable[int]) -> int:
+        async with self._lock:
+            pending = {}
+            for user_id in user_ids:
+                items = self._pending.pop(user_id, None)
+                if items:
+                    pending[user_id] = items
+            return await self._write(pool, pending)
@@ -0,0 +1,77 @@
+from typing import Any, Dict, Iterator, Optional, Set
+import asyncpg
+import dataclasses
+
+_UPDATABLE = ("name", "value", "demand", "supply", "stock", "price", "buyable")
+
+
+@dataclasses.dataclass(repr=True, eq=True)
+class Item:
+    id: int
+    name: str
+    value: int
+    demand: int
+    supply: int
+    stock: int
+    price: int
+    buyable: bool = True
+
+
+class ItemCatalog:
+    """
+    In-memory copy of the ``items`` table with a lowercase name index.
+
+    The table is loaded once and then kept current from ``market`` events.
+    """
+
+    def __init__(self) -> None:
+        self._items: Dict[int, Item] = {}
+        self._names: Dict[str, int] = {}
+        self.buyable: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[Item]:
+        return iter(sorted(self._items.values(), key=lambda i: i.id))
+
+    async def load(self, pool: asyncpg.Pool) -> None:
+        records = await pool.fetch(
+            "SELECT id, name, value, demand, supply, stock, price, buyable FROM items"
+        )
+        self._items.clear()
+        self._names.clear()
+        self.buyable.clear()
+        for record in records:
+            self._add(Item(**record))
+
+    def _add(self, item: Item) -> None:
+        self._items[item.id] = item
+        self._names[item.name.lower()] = item.id
+        if item.buyable:
+            self.buyable.add(item.id)
+        else:
+            self.buyable.discard(item.id)
+
+    def get(self, item_id: int) -> Optional[Item]:
+        return self._items.get(item_id)
+
+    def find(self, name: str) -> Optional[Item]:
+        item_id = self._names.get(name.lower())
+        return None if item_id is None else self._items[item_id]
+
+    def apply(self, event: Dict[str, Any]) -> None:
+        """
+        Updates an item from a ``market`` event
+        """
+        item = self._items.get(event["id"])
+        if item is None:
+            fields = {i.name for i in dataclasses.fields(Item)}
+            self._add(Item(**{k: v for k, v in event.items() if k in fields}))
+            return
+        if event.get("name", item.name) != item.name:
+            self._names.pop(item.name.lower(), None)
+        for field in _UPDATABLE:
+            if field in event:
+                setattr(item, field, event[field])
+        self._add(item)
@@ -1,19 +1,31 @@
-from discord.ext import commands
+from discord.ext import commands, tasks
 from random import choices
-from asyncio import create_task
+from io import BytesIO
+from time import time
+from datetime import datetime, timezone
+from tabulate import tabulate
+from asyncio import CancelledError, create_task, sleep
 from bot import GrowContext, MessagedError
 from discord.utils import utcnow
-from typing import Optional, Union, Literal
+from typing import List, Optional, Union, Literal
 from ..constants import currency_emoji, currency_name, embed_color, GrowTube
 from ..trading import Trading
+from ..leaderboard import leaderboard, user_names
+from ..locks import user_lock
+from .. import ledger as ledger_kinds
+from ..ledger import ledger
+from ..users import registered_users, registration_check
+from ..views import ConfirmView, PageView
+from .buffer import CollectBuffer
+from .catalog import Item, ItemCatalog
+from .decay import decay
+from .history import PriceHistory
+from .orders import OrderBatcher
+from .ticker import MarketTicker
+from .transfer import TransferResult, pay, pay_many
+from .pricing import compute_transaction
+from .events import MARKET_CHANNEL, MarketPublisher, decode_events
 import discord
-import json
-
-
-def compute_transaction(amount: int):
-    if amount > 100000:
-        return int(amount + (amount * 0.03)), 3
-    return int(amount + (amount * 0.02)), 2
 
 
 def _quantity_convert(arg) -> Union[int, Literal["all"]]:
@@ -25,40 +37,224 @@ def _quantity_convert(arg) -> Union[int, Literal["all"]]:
         raise MessagedError(f"unknown value `{arg}`")
 
 
-def _trade_check(ctx: GrowContext):
+async def _trade_check(ctx: GrowContext):
     cog: Optional[Trading] = ctx.bot.get_cog("Trading")
     if cog is None:
         return True
-    session = cog.users.get(ctx.author.id)
-    if session:
-        if session.id in cog.trades:
-            raise MessagedError("You're currently trading")
+    if await cog.store.of(ctx.author.id) is not None:
+        raise MessagedError("You're currently trading")
     return True
 
 
-def _calculate_price(base: int, demand: int, supply: int, d_units: int, s_units: int):
-    try:
-        return int(base * (demand + 1 * d_units) / (supply + 1 * s_units))
-    except ZeroDivisionError:
-        return base
+INVENTORY_PAGE_SIZE = 15
+TRANSFER_MANY_LIMIT = 100
+
+_INVENTORY_COLUMNS = """
+SELECT inventory.item_id, items.name, inventory.quantity, items.price
+FROM inventory INNER JOIN items ON items.id = inventory.item_id
+"""
+
+# $1 user id, $2 limit
+_INVENTORY_FIRST_PAGE_QUERY = (
+    _INVENTORY_COLUMNS
+    + """
+WHERE inventory.user_id = $1
+ORDER BY inventory.quantity DESC, inventory.item_id DESC LIMIT $2
+"""
+)
+
+# $1 user id, $2 and $3 quantity and item id of the last row of the previous page, $4 limit
+_INVENTORY_PAGE_QUERY = (
+    _INVENTORY_COLUMNS
+    + """
+WHERE inventory.user_id = $1 AND (inventory.quantity, inventory.item_id) < ($2, $3)
+ORDER BY inventory.quantity DESC, inventory.item_id DESC LIMIT $4
+"""
+)
+
+_INVENTORY_TOTAL_QUERY = """
+SELECT COUNT(*), COALESCE(SUM(items.price * inventory.quantity), 0)
+FROM inventory INNER JOIN items ON items.id = inventory.item_id WHERE inventory.user_id = $1
+"""
 
 
 class Market(commands.Cog):
     def __init__(self, bot: GrowTube) -> None:
         self.bot = bot
+        self.catalog = ItemCatalog()
+        self.orders = OrderBatcher(bot.pool, on_update=self._publish)
+        self.history = PriceHistory()
+        self.collect_buffer = CollectBuffer(on_write=self._record_collects)
+        self.publisher = MarketPublisher(bot.redis)
+        self.ticker = MarketTicker(
+            self._render_live, interval=bot.MARKET_TICKER_INTERVAL
+        )
+        self._listener = bot.loop.create_task(self._listen())
+        bot.loop.create_task(self._ensure_leaderboard())
+        self.flush_history.start()
+        self.flush_collects.start()
+        self.flush_ledger.start()
+        self.reconcile_ledger.start()
+        self.decay_market.change_interval(seconds=bot.MARKET_DECAY_INTERVAL)
+        self.decay_market.start()
         super().__init__()
 
+    def cog_unload(self):
+        self._listener.cancel()
+        self.flush_history.cancel()
+        self.flush_collects.cancel()
+        self.flush_ledger.cancel()
+        self.reconcile_ledger.cancel()
+        self.decay_market.cancel()
+        self.ticker.close()
+        create_task(self.flush())
+
+    async def flush(self):
+        """
+        Sends queued market events and writes buffered collects, price
+        history and ledger entries to the database
+        """
+        await self.publisher.close()
+        await self.collect_buffer.flush(self.bot.pool)
+        await self.history.flush(self.bot.pool)
+        await ledger.flush(self.bot.pool)
+
+    def _record_collects(self, collected: dict):
+        for user_id, items in collected.items():
+            for item_id, quantity in items.items():
+                ledger.record(ledger_kinds.COLLECT, user_id, quantity, item_id=item_id)
+
+    def _publish(self, events: List[dict]):
+        now = time()
+        for event in events:
+            event["time"] = now
+            self.catalog.apply(event)
+        self.publisher.publish(events)
+
+    async def _listen(self):
+        await self.bot.wait_until_ready()
+        self.publisher.start()
+        while True:
+            try:
+                async with self.bot.redis.pubsub(
+                    ignore_subscribe_messages=True
+                ) as pubsub:
+                    # subscribe before loading, events published during the
+                    # load wait in the connection and are applied after it
+                    await pubsub.subscribe(MARKET_CHANNEL)
+                    await self.catalog.load(self.bot.pool)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            for event in decode_events(message["data"]):
+                                self._apply(event)
+            except CancelledError:
+                raise
+            except Exception:
+                self.bot.log.exception("Market listener failed, reloading")
+                await sleep(5)
+
+    async def _ensure_leaderboard(self):
+        await self.bot.wait_until_ready()
+        if not await leaderboard.exists(self.bot.redis):
+            count = await leaderboard.rebuild(self.bot.redis, self.bot.pool)
+            self.bot.log.info(f"Built currency leaderboard with {count} users")
+
+    def _apply(self, event: dict):
+        self.catalog.apply(event)
+        self.history.record(event["id"], event["price"], event["time"])
+        self.ticker.notify()
+
+    @tasks.loop(hours=1)
+    async def decay_market(self):
+        states = await decay(
+            self.bot.pool,
+            self.bot.redis,
+            self.bot.MARKET_DECAY_RATE,
+            interval=self.bot.MARKET_DECAY_INTERVAL,
+        )
+        if states:
+            self._publish(states)
+
+    @decay_market.before_loop
+    async def before_decay_market(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(seconds=30)
+    async def flush_history(self):
+        await self.history.flush(self.bot.pool)
+
+    @flush_history.before_loop
+    async def before_flush_history(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(seconds=10)
+    async def flush_collects(self):
+        await self.collect_buffer.flush(self.bot.pool)
+
+    @flush_collects.before_loop
+    async def before_flush_collects(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(seconds=10)
+    async def flush_ledger(self):
+        await ledger.flush(self.bot.pool)
+
+    @flush_ledger.before_loop
+    async def before_flush_ledger(self):
+        await self.bot.wait_until_ready()
+        await self._ensure_partitions()
+
+    async def _ensure_partitions(self):
+        try:
+            await ledger.ensure_partitions(self.bot.pool)
+        except Exception:
+            self.bot.log.exception("Failed to create ledger partitions")
+
+    @tasks.loop(hours=24)
+    async def reconcile_ledger(self):
+        await self._ensure_partitions()
+        await self._reconcile()
+
+    @reconcile_ledger.before_loop
+    async def before_reconcile_ledger(self):
+        await self.bot.wait_until_ready()
+
+    async def _reconcile(self) -> int:
+        await self.collect_buffer.flush(self.bot.pool)
+        mismatches = await ledger.reconcile(self.bot.pool)
+        if not mismatches:
+            return 0
+        self.bot.log.warning(f"{len(mismatches)} balances don't match the ledger")
+        log_channel = self.bot.get_channel(self.bot.CHANNEL_LOG)
+        if log_channel:
+            report = tabulate(
+                (
+                    (
+                        i["user_id"],
+                        i["item_id"] or currency_name,
+                        i["balance"],
+                        i["ledger"],
+                    )
+                    for i in mismatches
+                ),
+                ("user", "item", "balance", "ledger"),
+            )
+            await log_channel.send(
+                f"**{len(mismatches)}** balances don't match the ledger",
+                file=discord.File(BytesIO(report.encode()), "reconcile.txt"),
+            )
+        return len(mismatches)
+
     async def cog_check(self, ctx: GrowContext):
-        _ignored_cmd = {self.register, self.market}
+        _ignored_cmd = {
+            self.register,
+            self.market,
+            self.market_history,
+            self.market_live,
+        }
         if ctx.command in _ignored_cmd:
             return True
-        elif await self.bot.pool.fetchval(
-            "SELECT 1 FROM users WHERE id=$1", ctx.author.id
-        ):
-            if ctx.command == self.register:
-                raise MessagedError("You're already registered")
-            return True
-        raise MessagedError("You're not registered")
+        return await registration_check(ctx)
 
     @commands.command(aliases=["wlt"])
     async def wallet(self, ctx: GrowContext, user: discord.User = None):
@@ -88,7 +284,10 @@ class Market(commands.Cog):
         """
         Register yourself into the country
         """
+        if await registered_users.is_registered(self.bot.pool, ctx.author.id):
+            raise MessagedError("You're already registered")
         await self.bot.pool.execute("INSERT INTO users VALUES ($1, 0)", ctx.author.id)
+        registered_users.add(ctx.author.id)
         await ctx.reply("Registered!")
 
     @commands.command(aliases=["clt"])
@@ -97,50 +296,59 @@ class Market(commands.Cog):
         """
         Collect random items, maximum 2 use every 30 seconds
         """
-        item = choices([1, 2, 3, 4, 5, 6], [50, 45, 30, 50, 15, 15])[0]
-        item = await self.bot.pool.fetchrow(
-            "SELECT name, id FROM items WHERE id=$1", item
+        item = self.catalog.get(
+            choices([1, 2, 3, 4, 5, 6], [50, 45, 30, 50, 15, 15])[0]
         )
-        if not await self.bot.pool.fetchrow(
-            "SELECT 1 FROM inventory WHERE item_id=$1 AND user_id=$2",
-            item[1],
-            ctx.author.id,
-        ):
-            await self.bot.pool.execute(
-                "INSERT INTO inventory VALUES ($1, $2)", item[1], ctx.author.id
-            )
-        else:
-            await self.bot.pool.execute(
-                "UPDATE inventory SET quantity = quantity + 1 WHERE item_id=$1 AND user_id=$2",
-                item[1],
-                ctx.author.id,
-            )
-        await ctx.reply(f"You found **{item[0]}** from the street")
+        if item is None:
+            # the catalog hasn't loaded yet
+            ctx.command.reset_cooldown(ctx)
+            raise MessagedError("The market isn't ready yet, try again later")
+        self.collect_buffer.add(ctx.author.id, item.id)
+        await ctx.reply(f"You found **{item.name}** from the street")
 
     @commands.command(aliases=["inv"])
     async def inventory(self, ctx: GrowContext):
         """
         Get your inventory contents
         """
-        records = await self.bot.pool.fetch(
-            "SELECT items.name, inventory.quantity, items.demand, items.supply, items.stock, items.value FROM inventory INNER JOIN items ON inventory.item_id=items.id WHERE user_id=$1 ORDER BY inventory.quantity DESC",
-            ctx.author.id,
+        await self.collect_buffer.flush_users(self.bot.pool, [ctx.author.id])
+        count, total = await self.bot.pool.fetchrow(
+            _INVENTORY_TOTAL_QUERY, ctx.author.id
         )
-        items = []
-        summed = []
-        for record in records:
-            price = (
-                _calculate_price(record[5], record[2], record[3], 0, record[4])
-                * record[1]
-            )
-            summed.append(price)
-            items.append(
-                f"{record[0].title()}: {record[1]:,} | Estimated Value: {price:,}"
+        if not count:
+            return await ctx.reply("```\nEmpty....```")
+        pages = -(-count // INVENTORY_PAGE_SIZE)
+
+        async def fetch_page(cursor):
+            if cursor is None:
+                records = await self.bot.pool.fetch(
+                    _INVENTORY_FIRST_PAGE_QUERY, ctx.author.id, INVENTORY_PAGE_SIZE + 1
+                )
+            else:
+                records = await self.bot.pool.fetch(
+                    _INVENTORY_PAGE_QUERY,
+                    ctx.author.id,
+                    *cursor,
+                    INVENTORY_PAGE_SIZE + 1,
+                )
+            if not records:
+                return "```\nEmpty....```", None
+            more = len(records) > INVENTORY_PAGE_SIZE
+            records = records[:INVENTORY_PAGE_SIZE]
+            items = [
+                f"{name.title()}: {quantity:,} | Estimated Value: {price * quantity:,}"
+                for _, name, quantity, price in records
+            ]
+            items.append(f"\nEstimated Total Values: {total:,}")
+            if pages > 1:
+                items.append(f"Page {view.page}/{pages}")
+            next_cursor = (
+                (records[-1]["quantity"], records[-1]["item_id"]) if more else None
             )
-        if summed:
-            items.append(f"\nEstimated Total Values: {sum(summed):,}")
-        records = "\n".join(items) or "Empty...."
-        await ctx.reply("```\n" + records + "```")
+            return "```\n" + "\n".join(items) + "```", next_cursor
+
+        view = PageView(ctx, fetch_page, timeout=120)
+        await view.start()
 
     @commands.command()
     @commands.check(_trade_check)
@@ -149,77 +357,77 @@ class Market(commands.Cog):
         ctx: GrowContext,
         quantity: Optional[_quantity_convert] = 1,
         *,
-        item_name,
+        item_name=None,
     ):
         """
-        Sells any item excluding non buyable
+        Sells any item excluding non buyable, separate names with commas to sell several items and use `sell all` alone to sell everything
         """
         quantity: Union[int, Literal["all"]] = quantity
         if quantity != "all" and quantity <= 0:
             return
-        record = await self.bot.pool.fetchrow(
-            "SELECT inventory.item_id, inventory.quantity, items.value, items.name, items.supply, items.demand, items.stock FROM inventory INNER JOIN items ON items.id = inventory.item_id WHERE LOWER(items.name) = $1 AND user_id = $2",
-            item_name.lower(),
-            ctx.author.id,
-        )
-        if record is None:
+        if item_name is None:
+            if quantity != "all":
+                return await ctx.send_help(ctx.command)
+            view = ConfirmView(ctx, timeout=30)
+            if not await view.prompt(
+                f"{ctx.author.mention} are you sure you want to sell your whole inventory?"
+            ):
+                return await ctx.reply("Cancelled")
+            return await self._sell_many(ctx, None, None)
+        items = []
+        for name in filter(None, map(str.strip, item_name.split(","))):
+            item = self.catalog.find(name)
+            if item is None:
+                return
+            items.append(item)
+        if len(items) > 1:
+            return await self._sell_many(
+                ctx, items, None if quantity == "all" else quantity
+            )
+        if not items:
             return
-        value = record[2]
-        if quantity == "all":
-            quantity = record[1]
-        remaining = record[1] - quantity
-        if remaining < 0:
+        item = items[0]
+        async with user_lock(self.bot, ctx.author.id):
+            await self.collect_buffer.flush_users(self.bot.pool, [ctx.author.id])
+            fill = await self.orders.sell(
+                ctx.author.id, item.id, None if quantity == "all" else quantity
+            )
+        if not fill.filled:
             return
-        currency = _calculate_price(value, record[5], record[4], 0, record[6])
-        if currency < 0:
-            currency = 0
-        currency *= quantity
-        total, tax = compute_transaction(currency)
-        currency = currency - (total - currency)
-        if record:
-            async with self.bot.pool.acquire() as conn:
-                async with conn.transaction():
-                    if remaining == 0:
-                        await conn.execute(
-                            "DELETE FROM inventory WHERE user_id = $1 AND item_id = $2",
-                            ctx.author.id,
-                            record[0],
-                        )
-                    else:
-                        await conn.execute(
-                            "UPDATE inventory SET quantity = $1 WHERE user_id = $2 AND item_id = $3",
-                            remaining,
-                            ctx.author.id,
-                            record[0],
-                        )
-                    await conn.execute(
-                        "UPDATE items SET supply = supply + 1, stock = stock + $1 WHERE id = $2",
-                        quantity,
-                        record[0],
-                    )
-                    create_task(
-                        self.bot.redis.publish(
-                            "market",
-                            json.dumps(
-                                {
-                                    "id": record[0],
-                                    "name": record[3],
-                                    "value": value,
-                                    "demand": record[5],
-                                    "supply": record[4] + 1,
-                                    "stock": record[6] + quantity,
-                                }
-                            ),
-                        )
-                    )
-                    await conn.execute(
-                        "UPDATE users SET currency = currency + $1 WHERE id = $2",
-                        currency,
-                        ctx.author.id,
-                    )
-            await ctx.send(
-                f"Sold **{quantity}** {record[3]} for **{currency:,} {currency_name}** {currency_emoji} with {tax}% tax"
+        leaderboard.record(self.bot.redis, {ctx.author.id: fill.total})
+        ledger.record(ledger_kinds.SELL, ctx.author.id, fill.total)
+        ledger.record(ledger_kinds.SELL, ctx.author.id, -fill.quantity, item_id=item.id)
+        _, tax = compute_transaction(fill.subtotal)
+        await ctx.send(
+            f"Sold **{fill.quantity}** {item.name} for **{fill.total:,} {currency_name}** {currency_emoji} with {tax}% tax"
+        )
+
+    async def _sell_many(
+        self, ctx: GrowContext, items: Optional[List[Item]], quantity: Optional[int]
+    ):
+        async with user_lock(self.bot, ctx.author.id):
+            await self.collect_buffer.flush_users(self.bot.pool, [ctx.author.id])
+            fills = await self.orders.sell_many(
+                ctx.author.id,
+                None if items is None else [i.id for i in items],
+                quantity,
             )
+        if not fills:
+            return await ctx.reply("You don't have anything to sell")
+        payout = sum(i.total for i in fills.values())
+        leaderboard.record(self.bot.redis, {ctx.author.id: payout})
+        ledger.record(ledger_kinds.SELL, ctx.author.id, payout)
+        for item_id, fill in fills.items():
+            ledger.record(
+                ledger_kinds.SELL, ctx.author.id, -fill.quantity, item_id=item_id
+            )
+        sold = ", ".join(
+            f"**{fill.quantity}** {self.catalog.get(item_id).name}"
+            for item_id, fill in fills.items()
+        )
+        await ctx.send(
+            f"Sold {sold} for **{payout:,} {currency_name}** {currency_emoji}"
+        )
 
     @commands.command()
     @commands.check(_trade_check)
@@ -229,137 +437,209 @@ class Market(commands.Cog):
         """
         if quantity <= 0:
             return
-        record = await self.bot.pool.fetchrow(
-            "SELECT items.id, items.value, items.name, items.supply, items.demand, items.stock FROM items WHERE LOWER(items.name) = $1 AND buyable",
-            item_name.lower(),
-        )
-        if record is None:
+        item = self.catalog.find(item_name)
+        if item is None or item.id not in self.catalog.buyable:
             return
-        if record[5] == 0:
+        async with user_lock(self.bot, ctx.author.id):
+            fill = await self.orders.buy(ctx.author.id, item.id, quantity)
+        if fill.out_of_stock:
             return await ctx.reply("Stock is empty....")
-        currency = await self.bot.pool.fetchval(
-            "SELECT currency FROM users WHERE id = $1", ctx.author.id
-        )
-        if record is None:
+        if not fill.filled:
             return
-        value = record[1]
-        price = _calculate_price(value, record[4], record[3], 0, record[5])
-        if price < 0:
-            price = 1
-        price_total, tax = compute_transaction(price * quantity)
-        remaining = currency - price_total
-        if remaining < 0 or (record[5] - quantity) < 0:
-            return
-        async with self.bot.pool.acquire() as conn:
-            async with conn.transaction():
-                if await conn.fetchval(
-                    "SELECT 1 FROM inventory WHERE item_id = $1 AND user_id = $2",
-                    record[0],
-                    ctx.author.id,
-                ):
-                    await conn.execute(
-                        "UPDATE inventory SET quantity = quantity + $1 WHERE user_id = $2 AND item_id = $3",
-                        quantity,
-                        ctx.author.id,
-                        record[0],
-                    )
-                else:
-                    await conn.execute(
-                        "INSERT INTO inventory VALUES ($1,$2,$3)",
-                        record[0],
-                        ctx.author.id,
-                        quantity,
-                    )
-                await conn.execute(
-                    "UPDATE items SET demand = demand + 1, stock = stock - $1 WHERE id = $2 AND stock > 0",
-                    quantity,
-                    record[0],
-                )
-                create_task(
-                    self.bot.redis.publish(
-                        "market",
-                        json.dumps(
-                            {
-                                "id": record[0],
-                                "name": record[2],
-                                "value": value,
-                                "demand": record[4] + 1,
-                                "supply": record[3],
-                                "stock": record[5] - quantity,
-                            }
-                        ),
-                    )
-                )
-                await conn.execute(
-                    "UPDATE users SET currency = $1 WHERE id = $2",
-                    remaining,
-                    ctx.author.id,
-                )
-            await ctx.send(
-                f"Bought **{quantity}** {record[2]} for **{price_total:,} {currency_name}** {currency_emoji} with {tax}% tax"
-            )
+        leaderboard.record(self.bot.redis, {ctx.author.id: -fill.total})
+        ledger.record(ledger_kinds.BUY, ctx.author.id, -fill.total)
+        ledger.record(ledger_kinds.BUY, ctx.author.id, fill.quantity, item_id=item.id)
+        _, tax = compute_transaction(fill.subtotal)
+        await ctx.send(
+            f"Bought **{quantity}** {item.name} for **{fill.total:,} {currency_name}** {currency_emoji} with {tax}% tax"
+        )
 
-    @commands.command(aliases=["mkt", "ma"])
+    @commands.group(aliases=["mkt", "ma"], invoke_without_command=True)
     async def market(self, ctx: GrowContext):
         """
         List items prices and quantities
         """
-        records = await self.bot.pool.fetch(
-            "SELECT id, name, value, demand, supply, stock FROM items WHERE buyable ORDER BY id ASC"
-        )
+        await ctx.send(self._render_board())
+
+    def _render_board(self) -> str:
         items = [
-            f"P: {_calculate_price(record[2], record[3], record[4], 0, record[5]):<10,} Q: {record[5]: <5} {record[1]}"
-            for record in records
+            f"P: {item.price:<10,} Q: {item.stock: <5} {item.name}"
+            for item in self.catalog
+            if item.buyable
         ]
-        await ctx.send("```\n" + ("\n".join(items)) + "\n```")
+        return "```\n" + ("\n".join(items)) + "\n```"
 
-    @commands.command()
+    def _render_live(self) -> str:
+        return self._render_board() + f"Updated <t:{int(time())}:R>"
+
+    @market.command(name="live")
+    @commands.has_permissions(manage_messages=True)
+    async def market_live(
+        self, ctx: GrowContext, stop: Optional[Literal["stop"]] = None
+    ):
+        """
+        Posts a market board that updates as prices change, `stop` to stop updating it
+        """
+        if stop:
+            if self.ticker.remove(ctx.channel.id) is None:
+                raise MessagedError("There's no live market in this channel")
+            return await ctx.reply("Stopped the live market")
+        self.ticker.add(await ctx.send(self._render_live()))
+
+    @market.command(name="stats")
+    @commands.is_owner()
+    async def market_stats(self, ctx: GrowContext):
+        """
+        Market event publisher and buffer metrics
+        """
+        publisher = self.publisher
+        await ctx.send(
+            "```\n"
+            + tabulate(
+                (
+                    ("messages queued", publisher.depth),
+                    ("messages published", publisher.published),
+                    ("messages dropped", publisher.dropped),
+                    ("buffered collects", len(self.collect_buffer)),
+                    ("unsaved candles", len(self.history)),
+                ),
+            )
+            + "```"
+        )
+
+    @market.command(name="reconcile")
+    @commands.is_owner()
+    async def market_reconcile(self, ctx: GrowContext):
+        """
+        Checks every balance against the ledger
+        """
+        mismatches = await self._reconcile()
+        await ctx.reply(
+            f"**{mismatches}** balances don't match the ledger"
+            if mismatches
+            else "Every balance matches the ledger"
+        )
+
+    @market.command(name="history", aliases=["hist"])
+    async def market_history(
+        self,
+        ctx: GrowContext,
+        resolution: Optional[Literal["1m", "1h", "1d"]] = "1h",
+        *,
+        item_name,
+    ):
+        """
+        Price candles of an item, resolution is one of 1m, 1h and 1d
+        """
+        item = self.catalog.find(item_name)
+        if item is None:
+            raise MessagedError(f"unknown item `{item_name}`")
+        candles = await self.history.candles(self.bot.pool, item.id, resolution)
+        if not candles:
+            return await ctx.send(f"No history for **{item.name}** yet")
+        time_format = "%m-%d" if resolution == "1d" else "%m-%d %H:%M"
+        rows = (
+            (
+                datetime.fromtimestamp(i.start, timezone.utc).strftime(time_format),
+                f"{i.open:,}",
+                f"{i.high:,}",
+                f"{i.low:,}",
+                f"{i.close:,}",
+                i.trades,
+            )
+            for i in candles
+        )
+        await ctx.send(
+            f"**{item.name}** ({resolution})\n```\n"
+            + tabulate(rows, ("time", "open", "high", "low", "close", "trades"))
+            + "```"
+        )
+
+    @commands.group(invoke_without_command=True)
     async def top(self, ctx: GrowContext, limit: Optional[int] = 10):
 
         """
         List top [limit] users with the highest amount of currency
         """
 
-        if limit > 30:
-            limit = 30
+        limit = max(1, min(limit, 30))
 
-        items = await self.bot.pool.fetch(
-            "SELECT id, currency FROM users ORDER BY currency DESC LIMIT $1", limit
-        )
+        items = await leaderboard.top(self.bot.redis, limit)
+        names = await user_names.resolve(self.bot, [i[0] for i in items])
         await ctx.reply(
             embed=discord.Embed(
                 description="\n".join(
-                    f"**#{index+1}** {self.bot.get_user(i[0])}: __{i[1]:,}__ {currency_emoji}"
+                    f"**#{index+1}** {names[i[0]]}: __{i[1]:,}__ {currency_emoji}"
                     for index, i in enumerate(items)
                 ),
                 color=embed_color,
             )
         )
 
-    @commands.command()
+    @top.command()
+    @commands.is_owner()
+    async def rebuild(self, ctx: GrowContext):
+        """
+        Rebuilds the leaderboard from the database
+        """
+        count = await leaderboard.rebuild(self.bot.redis, self.bot.pool)
+        await ctx.reply(f"Rebuilt the leaderboard with **{count:,}** users")
+
+    def _record_transfer(self, sender: int, result: TransferResult, amount: int):
+        deltas = {i: amount for i in result.recipients}
+        deltas[sender] = -result.total
+        leaderboard.record(self.bot.redis, deltas)
+        for recipient in result.recipients:
+            ledger.record(
+                ledger_kinds.TRANSFER, sender, -amount, counterparty=recipient
+            )
+            ledger.record(ledger_kinds.TRANSFER, recipient, amount, counterparty=sender)
+
+    @commands.group(invoke_without_command=True)
     async def transfer(self, ctx: GrowContext, user: discord.User, amount: int):
         """
         Transfers money from your wallet to another user wallet
         """
-        if user == ctx.author.id:
+        if user.id == ctx.author.id:
             return await ctx.reply("Haha no")
-        async with self.bot.pool.acquire() as conn:
-            record = await conn.fetchval("SELECT 1 FROM users WHERE id = $1", user.id)
-            if not record:
-                return
-            currency = await conn.fetchval(
-                "SELECT currency FROM users WHERE id = $1", ctx.author.id
+        if amount <= 0:
+            return
+        async with user_lock(self.bot, ctx.author.id, user.id):
+            result = await pay(self.bot.pool, ctx.author.id, user.id, amount)
+        if not result.registered:
+            raise MessagedError("User is not registered")
+        if not result.ok:
+            raise MessagedError(f"You don't have enough {currency_name}")
+        self._record_transfer(ctx.author.id, result, amount)
+        await ctx.send(f"Transfered **{amount:,}** {currency_emoji} to **{user}**")
+
+    @transfer.command(name="many")
+    async def transfer_many(
+        self, ctx: GrowContext, amount: int, users: commands.Greedy[discord.User]
+    ):
+        """
+        Transfers the same amount to every user, for giveaways and event payouts
+        """
+        recipients = {i.id for i in users if i.id != ctx.author.id}
+        if amount <= 0 or not recipients:
+            return
+        if len(recipients) > TRANSFER_MANY_LIMIT:
+            raise MessagedError(
+                f"You can only transfer to {TRANSFER_MANY_LIMIT} users at once"
             )
-            if amount > currency:
-                return
-            await conn.execute(
-                "UPDATE users SET currency = currency + $1 WHERE id = $2",
-                amount,
-                user.id,
+        async with user_lock(self.bot, ctx.author.id):
+            result = await pay_many(
+                self.bot.pool, ctx.author.id, dict.fromkeys(recipients, amount)
             )
-            await conn.execute(
-                "UPDATE users SET currency = currency - $1 WHERE id = $2",
-                amount,
-                ctx.author.id,
+        if not result.registered:
+            raise MessagedError("None of these users are registered")
+        if not result.ok:
+            raise MessagedError(
+                f"You need **{amount * len(result.registered):,}** {currency_name} {currency_emoji}"
             )
-            await ctx.send(f"Transfered **{amount:,}** {currency_emoji} to **{user}**")
+        self._record_transfer(ctx.author.id, result, amount)
+        skipped = len(recipients) - len(result.recipients)
+        await ctx.send(
+            f"Transfered **{amount:,}** {currency_emoji} to **{len(result.recipients)}** users"
+            + (f", skipped {skipped} unregistered users" if skipped else "")
+        )
@@ -0,0 +1,36 @@
+from typing import Any, Dict, List
+import aioredis
+import asyncpg
+
+DECAY_LOCK_KEY = "market:decay"
+
+# $1 rate, moves demand and supply a share of the way toward their mean,
+# always by at least 1 so small gaps close too
+_DECAY_QUERY = """
+WITH gaps AS (
+    SELECT id, (demand + supply) / 2 AS mean,
+        demand - (demand + supply) / 2 AS demand_gap, supply - (demand + supply) / 2 AS supply_gap
+    FROM items WHERE demand <> supply FOR UPDATE
+)
+UPDATE items SET
+    demand = gaps.mean + sign(gaps.demand_gap)::bigint
+        * GREATEST(abs(gaps.demand_gap) - GREATEST(ceil(abs(gaps.demand_gap) * $1::float8)::bigint, 1), 0),
+    supply = gaps.mean + sign(gaps.supply_gap)::bigint
+        * GREATEST(abs(gaps.supply_gap) - GREATEST(ceil(abs(gaps.supply_gap) * $1::float8)::bigint, 1), 0)
+FROM gaps WHERE items.id = gaps.id
+RETURNING items.id, items.name, items.value, items.demand, items.supply, items.stock, items.price
+"""
+
+
+async def decay(
+    pool: asyncpg.Pool, redis: aioredis.Redis, rate: float, *, interval: float
+) -> List[Dict[str, Any]]:
+    """
+    Decays demand and supply of every item toward equilibrium in one update
+
+    Only one process decays per ``interval`` seconds. Returns the new state of
+    every changed item.
+    """
+    if not await redis.set(DECAY_LOCK_KEY, 1, nx=True, ex=max(int(interval) - 1, 1)):
+        return []
+    return [dict(i) for i in await pool.fetch(_DECAY_QUERY, rate)]
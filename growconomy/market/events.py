@@ -0,0 +1,125 @@
+from typing import Any, Dict, List, Optional, Tuple
+import aioredis
+import asyncio
+import logging
+import struct
+
+MARKET_CHANNEL = "market"
+
+# id, value, demand, supply, stock, price, time, name length, followed by the
+# utf-8 name
+_EVENT = struct.Struct("<qqqqqqdH")
+_FIELDS = ("id", "value", "demand", "supply", "stock", "price", "time")
+
+log = logging.getLogger(__name__)
+
+
+def encode_event(event: Dict[str, Any]) -> bytes:
+    name = event["name"].encode()
+    return _EVENT.pack(*(event[i] for i in _FIELDS), len(name)) + name
+
+
+def _decode(data: bytes, offset: int) -> Tuple[Dict[str, Any], int]:
+    *values, length = _EVENT.unpack_from(data, offset)
+    event = dict(zip(_FIELDS, values))
+    offset += _EVENT.size
+    event["name"] = data[offset : offset + length].decode()
+    return event, offset + length
+
+
+def encode_events(events: List[Dict[str, Any]]) -> bytes:
+    """
+    Packs several events into one message, events are concatenated
+    """
+    return b"".join(map(encode_event, events))
+
+
+def decode_events(data: bytes) -> List[Dict[str, Any]]:
+    events = []
+    offset = 0
+    while offset < len(data):
+        event, offset = _decode(data, offset)
+        events.append(event)
+    return events
+
+
+class MarketPublisher:
+    """
+    Publishes market events to :data:`MARKET_CHANNEL` in batches.
+
+    :meth:`publish` only queues a message of one or more events, a background
+    task sends whatever is queued through one pipeline per batch. Messages
+    are dropped instead of queued once ``maxsize`` messages are waiting, and
+    batches that fail to send are dropped too; both are counted in
+    :attr:`dropped`.
+    """
+
+    def __init__(
+        self,
+        redis: aioredis.Redis,
+        *,
+        maxsize: int = 10000,
+        batch_size: int = 500,
+    ) -> None:
+        self._redis = redis
+        self._queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize)
+        self.batch_size = batch_size
+        self.published = 0
+        self.dropped = 0
+        self._task: Optional[asyncio.Task] = None
+        # the batch being sent, shielded so close() can still finish it
+        self._sending: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def publish(self, events: List[Dict[str, Any]]) -> None:
+        """
+        Queues events to be sent together in one message
+        """
+        try:
+            self._queue.put_nowait(encode_events(events))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        """
+        Stops the background task after sending what is still queued
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._sending is not None:
+            await self._sending
+            self._sending = None
+        while not self._queue.empty():
+            await self._send(self._drain([]))
+
+    def _drain(self, batch: list) -> list:
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _send(self, batch: list) -> None:
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for data in batch:
+                    pipe.publish(MARKET_CHANNEL, data)
+                await pipe.execute()
+        except Exception:
+            self.dropped += len(batch)
+            log.exception(f"Dropped {len(batch)} market messages")
+        else:
+            self.published += len(batch)
+
+    async def run(self) -> None:
+        while True:
+            batch = self._drain([await self._queue.get()])
+            self._sending = asyncio.create_task(self._send(batch))
+            await asyncio.shield(self._sending)
+            self._sending = None
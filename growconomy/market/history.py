@@ -0,0 +1,129 @@
+from typing import Deque, Dict, List, Tuple
+from collections import deque
+import asyncpg
+import dataclasses
+
+# resolution name -> candle width in seconds
+RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+
+_FLUSH_QUERY = """
+INSERT INTO price_history (item_id, resolution, start, open, high, low, close, trades)
+SELECT * FROM unnest(
+    $1::bigint[], $2::integer[], $3::bigint[], $4::bigint[],
+    $5::bigint[], $6::bigint[], $7::bigint[], $8::integer[]
+)
+ON CONFLICT (item_id, resolution, start) DO UPDATE SET
+    high = GREATEST(price_history.high, EXCLUDED.high),
+    low = LEAST(price_history.low, EXCLUDED.low),
+    close = EXCLUDED.close,
+    trades = GREATEST(price_history.trades, EXCLUDED.trades)
+"""
+
+
+@dataclasses.dataclass(repr=True)
+class Candle:
+    start: int
+    open: int
+    high: int
+    low: int
+    close: int
+    trades: int = 1
+
+    def update(self, price: int) -> None:
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.trades += 1
+
+
+class PriceHistory:
+    """
+    Aggregates market prices into OHLC candles for every resolution in
+    :data:`RESOLUTIONS`.
+
+    The newest ``capacity`` candles of each item and resolution are kept in
+    ring buffers, candles changed since the last :meth:`flush` are written to
+    ``price_history`` in one statement. Every bot process receives the same
+    events, the upsert only widens high/low so repeated flushes of the same
+    candle are harmless.
+    """
+
+    def __init__(self, *, capacity: int = 120) -> None:
+        self.capacity = capacity
+        self._series: Dict[Tuple[int, int], Deque[Candle]] = {}
+        self._dirty: Dict[Tuple[int, int, int], Candle] = {}
+
+    def __len__(self) -> int:
+        return len(self._dirty)
+
+    def record(self, item_id: int, price: int, timestamp: float) -> None:
+        for width in RESOLUTIONS.values():
+            start = int(timestamp) // width * width
+            series = self._series.get((item_id, width))
+            if series is None:
+                series = self._series[(item_id, width)] = deque(maxlen=self.capacity)
+            if series and series[-1].start == start:
+                candle = series[-1]
+                candle.update(price)
+            elif series and series[-1].start > start:
+                # late event for an older candle, it is already closed
+                continue
+            else:
+                candle = Candle(start, price, price, price, price)
+                series.append(candle)
+            self._dirty[(item_id, width, start)] = candle
+
+    async def flush(self, pool: asyncpg.Pool) -> int:
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        columns: List[list] = [[] for _ in range(8)]
+        for (item_id, width, start), candle in dirty.items():
+            row = (
+                item_id,
+                width,
+                start,
+                candle.open,
+                candle.high,
+                candle.low,
+                candle.close,
+                candle.trades,
+            )
+            for column, value in zip(columns, row):
+                column.append(value)
+        try:
+            await pool.execute(_FLUSH_QUERY, *columns)
+        except Exception:
+            # keep them for the next flush unless newer changes replaced them
+            for key, candle in dirty.items():
+                self._dirty.setdefault(key, candle)
+            raise
+        return len(dirty)
+
+    async def candles(
+        self, pool: asyncpg.Pool, item_id: int, resolution: str, limit: int = 24
+    ) -> List[Candle]:
+        """
+        Newest ``limit`` candles of an item, oldest first
+        """
+        width = RESOLUTIONS[resolution]
+        series = self._series.get((item_id, width), ())
+        candles = {i.start: i for i in series}
+        if len(candles) < limit:
+            records = await pool.fetch(
+                "SELECT start, open, high, low, close, trades FROM price_history WHERE item_id = $1 AND resolution = $2 ORDER BY start DESC LIMIT $3",
+                item_id,
+                width,
+                limit,
+            )
+            for record in records:
+                stored = Candle(**record)
+                candle = candles.get(stored.start)
+                if candle is not None:
+                    # this process may have started halfway through the candle
+                    stored.high = max(stored.high, candle.high)
+                    stored.low = min(stored.low, candle.low)
+                    stored.close = candle.close
+                    stored.trades = max(stored.trades, candle.trades)
+                candles[stored.start] = stored
+        return [candles[i] for i in sorted(candles)[-limit:]]
@@ -0,0 +1,368 @@
+from typing import Any, Callable, Dict, List, Optional
+from asyncio import Future, Lock, get_running_loop, sleep
+from .pricing import _calculate_price, compute_transaction
+import asyncpg
+import dataclasses
+
+BUY = 0
+SELL = 1
+
+# $1 item id, $2 user id, $3 quantity
+_BUY_QUERY = """
+WITH item AS (
+    SELECT stock, price
+    FROM items WHERE id = $1 AND buyable FOR UPDATE
+), priced AS (
+    SELECT stock, CASE WHEN price < 0 THEN 1 ELSE price END * $3 AS subtotal FROM item
+), charge AS (
+    SELECT stock, subtotal, market_total(subtotal) AS total FROM priced
+), paid AS (
+    UPDATE users SET currency = users.currency - charge.total FROM charge
+    WHERE users.id = $2 AND users.currency >= charge.total AND charge.stock >= $3
+    RETURNING users.currency
+), stocked AS (
+    UPDATE items SET demand = demand + 1, stock = stock - $3 FROM paid WHERE items.id = $1
+    RETURNING items.id, items.name, items.value, items.demand, items.supply, items.stock, items.price
+), owned AS (
+    INSERT INTO inventory (item_id, user_id, quantity) SELECT id, $2, $3 FROM stocked
+    ON CONFLICT (user_id, item_id) DO UPDATE SET quantity = inventory.quantity + EXCLUDED.quantity
+)
+SELECT charge.stock AS available, charge.subtotal, charge.total, paid.currency, stocked.*
+FROM charge LEFT JOIN paid ON TRUE LEFT JOIN stocked ON TRUE
+"""
+
+# $1 item id, $2 user id, $3 quantity or NULL for everything
+_SELL_QUERY = """
+WITH held AS (
+    SELECT inventory.quantity, items.price
+    FROM inventory INNER JOIN items ON items.id = inventory.item_id
+    WHERE inventory.item_id = $1 AND inventory.user_id = $2 FOR UPDATE
+), sale AS (
+    SELECT quantity, COALESCE($3::bigint, quantity) AS amount,
+        GREATEST(price, 0) * COALESCE($3::bigint, quantity) AS subtotal
+    FROM held WHERE quantity >= COALESCE($3::bigint, quantity)
+), proceeds AS (
+    SELECT quantity, amount, subtotal, 2 * subtotal - market_total(subtotal) AS payout FROM sale
+), removed AS (
+    DELETE FROM inventory USING proceeds
+    WHERE inventory.item_id = $1 AND inventory.user_id = $2 AND proceeds.amount = proceeds.quantity
+), kept AS (
+    UPDATE inventory SET quantity = inventory.quantity - proceeds.amount FROM proceeds
+    WHERE inventory.item_id = $1 AND inventory.user_id = $2 AND proceeds.amount < proceeds.quantity
+), stocked AS (
+    UPDATE items SET supply = supply + 1, stock = stock + proceeds.amount FROM proceeds
+    WHERE items.id = $1
+    RETURNING items.id, items.name, items.value, items.demand, items.supply, items.stock, items.price
+), paid AS (
+    UPDATE users SET currency = users.currency + proceeds.payout FROM proceeds
+    WHERE users.id = $2
+)
+SELECT proceeds.amount, proceeds.subtotal, proceeds.payout, stocked.* FROM proceeds, stocked
+"""
+
+ITEM_FIELDS = ("id", "name", "value", "demand", "supply", "stock", "price")
+
+_HELD_COLUMNS = """
+SELECT items.id, inventory.quantity, items.price
+FROM inventory INNER JOIN items ON items.id = inventory.item_id
+"""
+
+# $1 user id
+_HELD_QUERY = (
+    _HELD_COLUMNS
+    + """
+WHERE inventory.user_id = $1 ORDER BY items.id FOR UPDATE
+"""
+)
+
+# $1 user id, $2 item ids
+_HELD_ITEMS_QUERY = (
+    _HELD_COLUMNS
+    + """
+WHERE inventory.user_id = $1 AND inventory.item_id = ANY($2::bigint[]) ORDER BY items.id FOR UPDATE
+"""
+)
+
+
+@dataclasses.dataclass(repr=True)
+class Fill:
+    filled: bool
+    quantity: int = 0
+    subtotal: int = 0
+    total: int = 0  # charged for buys, paid out for sells
+    out_of_stock: bool = False
+
+
+@dataclasses.dataclass(repr=True)
+class Order:
+    side: int
+    user_id: int
+    quantity: Optional[int]  # None sells everything the user holds
+    future: Future
+
+
+class OrderBatcher:
+    """
+    Coalesces concurrent market orders on the same item.
+
+    Orders for an item are collected for ``window`` seconds and applied in one
+    transaction that updates the item row once. Inside the batch orders are
+    filled in arrival order with :func:`_calculate_price`, so every order gets
+    the price it would have had if the orders ran one after another. A batch
+    holding a single order runs as one statement instead.
+
+    ``on_update`` is called with a list of the new item states after every
+    batch.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        *,
+        window: float = 0.005,
+        on_update: Optional[Callable[[List[Dict[str, Any]]], Any]] = None,
+    ) -> None:
+        self._pool = pool
+        self.window = window
+        self.on_update = on_update
+        self._pending: Dict[int, List[Order]] = {}
+        self._locks: Dict[int, Lock] = {}
+
+    async def buy(self, user_id: int, item_id: int, quantity: int) -> Fill:
+        return await self._submit(BUY, user_id, item_id, quantity)
+
+    async def sell(self, user_id: int, item_id: int, quantity: Optional[int]) -> Fill:
+        return await self._submit(SELL, user_id, item_id, quantity)
+
+    async def sell_many(
+        self, user_id: int, item_ids: Optional[List[int]], quantity: Optional[int]
+    ) -> Dict[int, Fill]:
+        """
+        Sells several items of a user in one transaction
+
+        ``item_ids`` of ``None`` sells every item the user has, ``quantity`` of
+        ``None`` sells everything held of each item. Items the user doesn't
+        have enough of are left out of the result.
+        """
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                if item_ids is None:
+                    held = await conn.fetch(_HELD_QUERY, user_id)
+                else:
+                    held = await conn.fetch(_HELD_ITEMS_QUERY, user_id, item_ids)
+                held = [
+                    i for i in held if quantity is None or i["quantity"] >= quantity
+                ]
+                if not held:
+                    return {}
+                ids, owned, prices = zip(*held)
+                ids = list(ids)
+                amounts = list(owned) if quantity is None else [quantity] * len(held)
+                fills: Dict[int, Fill] = {}
+                for item_id, price, amount in zip(ids, prices, amounts):
+                    # same as sell, negative prices pay nothing
+                    subtotal = max(price, 0) * amount
+                    total, _ = compute_transaction(subtotal)
+                    fills[item_id] = Fill(True, amount, subtotal, 2 * subtotal - total)
+
+                states = await conn.fetch(
+                    """
+                    UPDATE items SET supply = supply + 1, stock = stock + v.amount
+                    FROM unnest($1::bigint[], $2::bigint[]) AS v(id, amount)
+                    WHERE items.id = v.id
+                    RETURNING items.id, items.name, items.value, items.demand, items.supply, items.stock, items.price
+                    """,
+                    ids,
+                    amounts,
+                )
+                await conn.execute(
+                    """
+                    UPDATE inventory SET quantity = inventory.quantity - v.amount
+                    FROM unnest($2::bigint[], $3::bigint[]) AS v(item_id, amount)
+                    WHERE inventory.user_id = $1 AND inventory.item_id = v.item_id
+                    """,
+                    user_id,
+                    ids,
+                    amounts,
+                )
+                await conn.execute(
+                    "DELETE FROM inventory WHERE user_id = $1 AND item_id = ANY($2::bigint[]) AND quantity <= 0",
+                    user_id,
+                    ids,
+                )
+                await conn.execute(
+                    "UPDATE users SET currency = currency + $2 WHERE id = $1",
+                    user_id,
+                    sum(i.total for i in fills.values()),
+                )
+        if self.on_update is not None:
+            self.on_update([dict(i) for i in states])
+        return fills
+
+    async def _submit(
+        self, side: int, user_id: int, item_id: int, quantity: Optional[int]
+    ) -> Fill:
+        future = get_running_loop().create_future()
+        orders = self._pending.get(item_id)
+        if orders is None:
+            orders = self._pending[item_id] = []
+            get_running_loop().create_task(self._flush(item_id))
+        orders.append(Order(side, user_id, quantity, future))
+        return await future
+
+    async def _flush(self, item_id: int) -> None:
+        await sleep(self.window)
+        lock = self._locks.setdefault(item_id, Lock())
+        async with lock:
+            orders = self._pending.pop(item_id)
+            try:
+                if len(orders) == 1:
+                    state, fills = await self._execute_one(item_id, orders[0])
+                else:
+                    state, fills = await self._execute_batch(item_id, orders)
+            except Exception as exc:
+                for order in orders:
+                    if not order.future.done():
+                        order.future.set_exception(exc)
+                return
+        if state is not None and self.on_update is not None:
+            self.on_update([state])
+        for order, fill in zip(orders, fills):
+            if not order.future.done():
+                order.future.set_result(fill)
+
+    async def _execute_one(self, item_id: int, order: Order):
+        if order.side == BUY:
+            record = await self._pool.fetchrow(
+                _BUY_QUERY, item_id, order.user_id, order.quantity
+            )
+            if record is None:
+                return None, [Fill(False)]
+            if record["currency"] is None:
+                return None, [Fill(False, out_of_stock=record["available"] == 0)]
+            fill = Fill(True, order.quantity, record["subtotal"], record["total"])
+        else:
+            record = await self._pool.fetchrow(
+                _SELL_QUERY, item_id, order.user_id, order.quantity
+            )
+            if record is None:
+                return None, [Fill(False)]
+            fill = Fill(True, record["amount"], record["subtotal"], record["payout"])
+        return {i: record[i] for i in ITEM_FIELDS}, [fill]
+
+    async def _execute_batch(self, item_id: int, orders: List[Order]):
+        user_ids = sorted({i.user_id for i in orders})
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                item = await conn.fetchrow(
+                    "SELECT id, name, value, demand, supply, stock, buyable FROM items WHERE id = $1 FOR UPDATE",
+                    item_id,
+                )
+                if item is None:
+                    return None, [Fill(False) for _ in orders]
+                wallets: Dict[int, int] = dict(
+                    await conn.fetch(
+                        "SELECT id, currency FROM users WHERE id = ANY($1::bigint[]) ORDER BY id FOR UPDATE",
+                        user_ids,
+                    )
+                )
+                held: Dict[int, int] = dict(
+                    await conn.fetch(
+                        "SELECT user_id, quantity FROM inventory WHERE item_id = $1 AND user_id = ANY($2::bigint[]) ORDER BY user_id FOR UPDATE",
+                        item_id,
+                        user_ids,
+                    )
+                )
+                state = dict(item)
+                before = dict(held)
+                fills = [self._fill(state, wallets, held, i) for i in orders]
+                if not any(i.filled for i in fills):
+                    return None, fills
+
+                filled_users = {o.user_id for o, f in zip(orders, fills) if f.filled}
+                state["price"] = await conn.fetchval(
+                    "UPDATE items SET demand = $2, supply = $3, stock = $4 WHERE id = $1 RETURNING price",
+                    item_id,
+                    state["demand"],
+                    state["supply"],
+                    state["stock"],
+                )
+                await conn.execute(
+                    """
+                    UPDATE users SET currency = v.currency
+                    FROM unnest($1::bigint[], $2::bigint[]) AS v(id, currency)
+                    WHERE users.id = v.id
+                    """,
+                    list(filled_users),
+                    [wallets[i] for i in filled_users],
+                )
+                # deltas, a row missing from the read can't be locked and may
+                # be inserted by a collect flush or a trade in the meantime
+                changed = [
+                    i for i in filled_users if held.get(i, 0) != before.get(i, 0)
+                ]
+                if changed:
+                    await conn.execute(
+                        """
+                        INSERT INTO inventory (item_id, user_id, quantity)
+                        SELECT $1, v.user_id, v.quantity
+                        FROM unnest($2::bigint[], $3::bigint[]) AS v(user_id, quantity)
+                        ON CONFLICT (user_id, item_id) DO UPDATE SET quantity = inventory.quantity + EXCLUDED.quantity
+                        """,
+                        item_id,
+                        changed,
+                        [held.get(i, 0) - before.get(i, 0) for i in changed],
+                    )
+                    await conn.execute(
+                        "DELETE FROM inventory WHERE item_id = $1 AND user_id = ANY($2::bigint[]) AND quantity <= 0",
+                        item_id,
+                        changed,
+                    )
+        return {i: state[i] for i in ITEM_FIELDS}, fills
+
+    @staticmethod
+    def _fill(
+        state: Dict[str, Any],
+        wallets: Dict[int, int],
+        held: Dict[int, int],
+        order: Order,
+    ) -> Fill:
+        """
+        Fills one order against the batch's running state, same rules as the
+        single order statements
+        """
+        price = _calculate_price(
+            state["value"], state["demand"], state["supply"], 0, state["stock"]
+        )
+        currency = wallets.get(order.user_id)
+        if currency is None:
+            return Fill(False)
+        if order.side == BUY:
+            if not state["buyable"]:
+                return Fill(False)
+            if state["stock"] == 0:
+                return Fill(False, out_of_stock=True)
+            subtotal = (1 if price < 0 else price) * order.quantity
+            total, _ = compute_transaction(subtotal)
+            if currency < total or state["stock"] < order.quantity:
+                return Fill(False)
+            wallets[order.user_id] = currency - total
+            held[order.user_id] = held.get(order.user_id, 0) + order.quantity
+            state["demand"] += 1
+            state["stock"] -= order.quantity
+            return Fill(True, order.quantity, subtotal, total)
+
+        owned = held.get(order.user_id)
+        if owned is None:
+            return Fill(False)
+        amount = owned if order.quantity is None else order.quantity
+        if owned < amount:
+            return Fill(False)
+        subtotal = max(price, 0) * amount
+        total, _ = compute_transaction(subtotal)
+        payout = 2 * subtotal - total
+        wallets[order.user_id] = currency + payout
+        held[order.user_id] = owned - amount
+        state["supply"] += 1
+        state["stock"] += amount
+        return Fill(True, amount, subtotal, payout)
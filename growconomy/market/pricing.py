@@ -0,0 +1,11 @@
+def compute_transaction(amount: int):
+    if amount > 100000:
+        return int(amount + (amount * 0.03)), 3
+    return int(amount + (amount * 0.02)), 2
+
+
+def _calculate_price(base: int, demand: int, supply: int, d_units: int, s_units: int):
+    try:
+        return int(base * (demand + 1 * d_units) / (supply + 1 * s_units))
+    except ZeroDivisionError:
+        return base
@@ -0,0 +1,35 @@
+from growconomy.market.events import decode_events, encode_event, encode_events
+import unittest
+
+
+def _event(item_id: int, name: str):
+    return {
+        "id": item_id,
+        "name": name,
+        "value": 100,
+        "demand": 12,
+        "supply": -3,
+        "stock": 2**40,
+        "price": 400,
+        "time": 1634567890.25,
+    }
+
+
+class EventsTest(unittest.TestCase):
+    def test_round_trip(self):
+        events = [_event(1, "Dirt"), _event(2, "Ñame 🌱"), _event(3, "")]
+        self.assertEqual(decode_events(encode_events(events)), events)
+
+    def test_messages_concatenate_events(self):
+        events = [_event(1, "Dirt"), _event(2, "Rock")]
+        self.assertEqual(
+            encode_events(events), encode_event(events[0]) + encode_event(events[1])
+        )
+
+    def test_empty(self):
+        self.assertEqual(encode_events([]), b"")
+        self.assertEqual(decode_events(b""), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
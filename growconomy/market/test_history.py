@@ -0,0 +1,56 @@
+from growconomy.market.history import RESOLUTIONS, Candle, PriceHistory
+import unittest
+
+MINUTE = RESOLUTIONS["1m"]
+
+
+class PriceHistoryTest(unittest.IsolatedAsyncioTestCase):
+    async def test_prices_in_one_minute_share_a_candle(self):
+        history = PriceHistory()
+        for price, timestamp in ((10, 60.0), (14, 75.5), (7, 90.0), (12, 119.9)):
+            history.record(1, price, timestamp)
+        # enough candles in memory, the pool isn't queried
+        (candle,) = await history.candles(None, 1, "1m", limit=1)
+        self.assertEqual(candle, Candle(60, 10, 14, 7, 12, 4))
+
+    async def test_rollover_starts_a_new_candle(self):
+        history = PriceHistory()
+        history.record(1, 10, 60.0)
+        history.record(1, 12, 110.0)
+        history.record(1, 20, 120.0)
+        history.record(1, 18, 179.0)
+        candles = await history.candles(None, 1, "1m", limit=2)
+        self.assertEqual(
+            candles, [Candle(60, 10, 12, 10, 12, 2), Candle(120, 20, 20, 18, 18, 2)]
+        )
+        # both fall in the same hour
+        (hour,) = await history.candles(None, 1, "1h", limit=1)
+        self.assertEqual(hour, Candle(0, 10, 20, 10, 18, 4))
+
+    async def test_late_events_are_dropped(self):
+        history = PriceHistory()
+        history.record(1, 10, 120.0)
+        history.record(1, 99, 60.0)
+        (candle,) = await history.candles(None, 1, "1m", limit=1)
+        self.assertEqual(candle, Candle(120, 10, 10, 10, 10, 1))
+
+    async def test_capacity_keeps_newest_candles(self):
+        history = PriceHistory(capacity=3)
+        for minute in range(5):
+            history.record(1, minute, minute * MINUTE)
+        candles = await history.candles(None, 1, "1m", limit=3)
+        self.assertEqual(
+            [i.start for i in candles], [2 * MINUTE, 3 * MINUTE, 4 * MINUTE]
+        )
+
+    def test_changed_candles_are_dirty(self):
+        history = PriceHistory()
+        history.record(1, 10, 60.0)
+        history.record(1, 11, 61.0)
+        history.record(2, 10, 60.0)
+        # one candle per item and resolution
+        self.assertEqual(len(history), 2 * len(RESOLUTIONS))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+from growconomy.market.orders import BUY, SELL, Fill, Order, OrderBatcher
+import unittest
+
+
+def _state(**kwargs):
+    state = {"value": 100, "demand": 10, "supply": 5, "stock": 5, "buyable": True}
+    state.update(kwargs)
+    return state
+
+
+def _order(side: int, user_id: int, quantity):
+    return Order(side, user_id, quantity, None)
+
+
+class FillTest(unittest.TestCase):
+    def test_batch_matches_single_orders(self):
+        # each order priced by market_price on the row the previous order left,
+        # charged or paid through market_total, as the single order statements do
+        expected = [
+            # 100 * 10 / (5 + 5) = 100, 200 + 2% = 204
+            (_order(BUY, 1, 2), Fill(True, 2, 200, 204)),
+            # 100 * 11 / (5 + 3) = 137, 137 + 2% = 139
+            (_order(BUY, 2, 1), Fill(True, 1, 137, 139)),
+            # 100 * 12 / (5 + 2) = 171, 684 - 2% = 671
+            (_order(SELL, 3, 4), Fill(True, 4, 684, 671)),
+            # 100 * 12 / (6 + 6) = 100, 300 + 2% = 306
+            (_order(BUY, 1, 3), Fill(True, 3, 300, 306)),
+            # 100 * 13 / (6 + 3) = 144, 144 - 2% = 142
+            (_order(SELL, 2, None), Fill(True, 1, 144, 142)),
+        ]
+        state, wallets, held = _state(), {1: 10000, 2: 10000, 3: 0}, {3: 4}
+        for order, fill in expected:
+            self.assertEqual(OrderBatcher._fill(state, wallets, held, order), fill)
+        self.assertEqual((state["demand"], state["supply"], state["stock"]), (13, 7, 4))
+        self.assertEqual(wallets, {1: 10000 - 204 - 306, 2: 10000 - 139 + 142, 3: 671})
+        self.assertEqual(held, {1: 5, 2: 0, 3: 0})
+
+    def test_later_orders_see_earlier_fills(self):
+        state, wallets, held = _state(), {1: 10000}, {}
+        first = OrderBatcher._fill(state, wallets, held, _order(BUY, 1, 2))
+        second = OrderBatcher._fill(state, wallets, held, _order(BUY, 1, 1))
+        # 100 * 10 / 10, then 100 * 11 / 8
+        self.assertEqual((first.subtotal, first.total), (200, 204))
+        self.assertEqual((second.subtotal, second.total), (137, 139))
+        self.assertEqual(wallets[1], 10000 - 204 - 139)
+        self.assertEqual(held[1], 3)
+
+    def test_rejected_orders_leave_state_untouched(self):
+        state, wallets, held = _state(), {1: 50, 2: 0}, {2: 1}
+        for order in (
+            _order(BUY, 1, 1),  # can't afford it
+            _order(BUY, 1, 6),  # more than in stock
+            _order(BUY, 3, 1),  # not registered
+            _order(SELL, 2, 2),  # holds less
+            _order(SELL, 1, 1),  # holds none
+        ):
+            self.assertFalse(OrderBatcher._fill(state, wallets, held, order).filled)
+        self.assertEqual(state, _state())
+        self.assertEqual((wallets, held), ({1: 50, 2: 0}, {2: 1}))
+
+    def test_out_of_stock(self):
+        fill = OrderBatcher._fill(_state(stock=0), {1: 100}, {}, _order(BUY, 1, 1))
+        self.assertEqual(fill, Fill(False, out_of_stock=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
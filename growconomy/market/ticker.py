@@ -0,0 +1,68 @@
+from typing import Callable, Dict, Optional
+import asyncio
+import discord
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class MarketTicker:
+    """
+    Keeps one message per channel showing the market board.
+
+    :meth:`notify` marks the board as changed, edits are coalesced so every
+    message is edited at most once per ``interval`` seconds and the board is
+    rendered once per round of edits.
+    """
+
+    def __init__(self, render: Callable[[], str], *, interval: float = 5.0) -> None:
+        self.render = render
+        self.interval = interval
+        self._messages: Dict[int, discord.Message] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._messages
+
+    def add(self, message: discord.Message) -> Optional[discord.Message]:
+        """
+        Starts editing ``message``, returns the message it replaced if the
+        channel already had one
+        """
+        old = self._messages.get(message.channel.id)
+        self._messages[message.channel.id] = message
+        return old
+
+    def remove(self, channel_id: int) -> Optional[discord.Message]:
+        return self._messages.pop(channel_id, None)
+
+    def notify(self) -> None:
+        self._dirty = True
+        if self._messages and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _edit(self, message: discord.Message, content: str) -> None:
+        try:
+            await message.edit(content=content)
+        except discord.NotFound:
+            if self._messages.get(message.channel.id) is message:
+                del self._messages[message.channel.id]
+        except discord.HTTPException:
+            log.exception(f"Failed to edit market ticker in {message.channel.id}")
+
+    async def _run(self) -> None:
+        while self._dirty and self._messages:
+            self._dirty = False
+            content = self.render()
+            await asyncio.gather(
+                *(self._edit(i, content) for i in list(self._messages.values()))
+            )
+            await asyncio.sleep(self.interval)
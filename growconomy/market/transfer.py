@@ -0,0 +1,73 @@
+from typing import List, Mapping, Optional
+import asyncpg
+import dataclasses
+
+# $1 sender id, $2 recipient ids, $3 amounts
+_TRANSFER_QUERY = """
+WITH recipients AS (
+    SELECT id, SUM(amount) AS amount FROM unnest($2::bigint[], $3::bigint[]) AS r(id, amount)
+    WHERE id <> $1 GROUP BY id
+), locked AS (
+    SELECT id, currency FROM users
+    WHERE id = $1 OR id IN (SELECT id FROM recipients)
+    ORDER BY id FOR UPDATE
+), paid AS (
+    SELECT recipients.id, recipients.amount FROM recipients INNER JOIN locked ON locked.id = recipients.id
+), total AS (
+    SELECT COALESCE(SUM(amount), 0)::bigint AS total FROM paid
+), debit AS (
+    UPDATE users SET currency = users.currency - total.total FROM locked, total
+    WHERE users.id = $1 AND locked.id = $1 AND total.total > 0 AND locked.currency >= total.total
+    RETURNING users.currency
+), credit AS (
+    UPDATE users SET currency = users.currency + paid.amount FROM paid, debit
+    WHERE users.id = paid.id
+    RETURNING users.id
+)
+SELECT (SELECT currency FROM debit) AS currency, total.total,
+    ARRAY(SELECT id FROM credit) AS recipients, ARRAY(SELECT id FROM paid) AS registered
+FROM total
+"""
+
+
+@dataclasses.dataclass(repr=True)
+class TransferResult:
+    # sender balance after the transfer, None if nothing was transferred
+    currency: Optional[int]
+    total: int
+    recipients: List[int]
+    # recipients that have an account, paid or not
+    registered: List[int]
+
+    @property
+    def ok(self) -> bool:
+        return self.currency is not None
+
+
+async def pay_many(
+    pool: asyncpg.Pool, sender: int, payouts: Mapping[int, int]
+) -> TransferResult:
+    """
+    Pays every recipient in ``payouts`` from the sender's wallet in one statement
+
+    All rows are locked in id order, so concurrent transfers can't deadlock
+    each other. Recipients without an account and the sender are skipped, if
+    the sender can't pay every remaining recipient nobody is paid.
+    """
+    if any(i <= 0 for i in payouts.values()):
+        raise ValueError("amounts must be positive")
+    record = await pool.fetchrow(
+        _TRANSFER_QUERY, sender, list(payouts.keys()), list(payouts.values())
+    )
+    return TransferResult(
+        record["currency"],
+        record["total"],
+        list(record["recipients"]),
+        list(record["registered"]),
+    )
+
+
+async def pay(
+    pool: asyncpg.Pool, sender: int, recipient: int, amount: int
+) -> TransferResult:
+    return await pay_many(pool, sender, {recipient: amount})
@@ -0,0 +1,63 @@
+from unittest import mock
+from growconomy.users import RegisteredUsers
+import unittest
+
+
+class FakePool:
+    def __init__(self, registered: set) -> None:
+        self.registered = registered
+        self.queries = 0
+
+    async def fetchval(self, query: str, user_id: int):
+        self.queries += 1
+        return 1 if user_id in self.registered else None
+
+
+class RegisteredUsersTest(unittest.IsolatedAsyncioTestCase):
+    async def test_registered_users_are_cached_forever(self):
+        users = RegisteredUsers()
+        pool = FakePool({1})
+        with mock.patch("growconomy.users.monotonic", return_value=0.0) as clock:
+            self.assertTrue(await users.is_registered(pool, 1))
+            clock.return_value = 1e9
+            self.assertTrue(await users.is_registered(pool, 1))
+        self.assertEqual(pool.queries, 1)
+
+    async def test_negative_entries_expire(self):
+        users = RegisteredUsers(negative_ttl=60.0)
+        pool = FakePool(set())
+        with mock.patch("growconomy.users.monotonic", return_value=0.0) as clock:
+            self.assertFalse(await users.is_registered(pool, 1))
+            clock.return_value = 59.0
+            self.assertFalse(await users.is_registered(pool, 1))
+            self.assertEqual(pool.queries, 1)
+
+            # registered by another process in the meantime
+            pool.registered.add(1)
+            clock.return_value = 61.0
+            self.assertTrue(await users.is_registered(pool, 1))
+        self.assertEqual(pool.queries, 2)
+
+    async def test_add_and_discard(self):
+        users = RegisteredUsers()
+        pool = FakePool(set())
+        users.add(1)
+        self.assertTrue(await users.is_registered(pool, 1))
+        users.discard(1)
+        self.assertFalse(await users.is_registered(pool, 1))
+        self.assertEqual(pool.queries, 1)
+
+    async def test_evicts_least_recently_used(self):
+        users = RegisteredUsers(maxsize=2)
+        users.add(1)
+        users.add(2)
+        self.assertTrue(await users.is_registered(FakePool(set()), 1))
+        users.add(3)
+        self.assertEqual(len(users), 2)
+        pool = FakePool(set())
+        self.assertFalse(await users.is_registered(pool, 2))
+        self.assertEqual(pool.queries, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
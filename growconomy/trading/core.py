@@ -1,73 +1,175 @@
-from asyncio.tasks import create_task, sleep
+from asyncio.tasks import create_task
 from asyncpg.connection import Connection
 from bot import GrowContext, MessagedError
 from discord.ext import commands
-from typing import Dict, List, Optional, Literal, Tuple
-from discord import User, Message, Embed
+from typing import Dict, List, Optional, Tuple
+from discord import User, Embed, PartialMessage
 from secrets import token_urlsafe
 from discord.utils import find
-from asyncio import Event
 from ..views import ConfirmView
 from ..constants import GrowTube, currency_name, embed_color
-from ..utils import async_any
-import dataclasses
+from ..leaderboard import leaderboard
+from ..locks import user_lock
+from .. import ledger as ledger_kinds
+from ..ledger import ledger
+from ..users import registered_users
+from .store import ACCEPT, CANCEL, TradeItem, TradeSession, TradeStore
 
+# $1 user ids, locked in id order like transfers
+_LOCK_CURRENCY_QUERY = """
+SELECT id, currency FROM users WHERE id = ANY($1::bigint[]) ORDER BY id FOR UPDATE
+"""
 
-@dataclasses.dataclass(repr=True, eq=True)
-class TradeItem:
-    type: Literal[0, 1] = dataclasses.field(compare=False)  # 0 for item, 1 for currency
-    amount: int = dataclasses.field(compare=False)
-    name: Optional[str] = dataclasses.field(default=None)
+# $1 user ids, $2 lowercased names of the traded items
+_LOCK_ITEMS_QUERY = """
+SELECT inventory.user_id, LOWER(items.name) AS key, inventory.item_id, inventory.quantity
+FROM inventory INNER JOIN items ON items.id = inventory.item_id
+WHERE inventory.user_id = ANY($1::bigint[]) AND LOWER(items.name) = ANY($2::text[])
+ORDER BY inventory.user_id, inventory.item_id FOR UPDATE OF inventory
+"""
 
-
-@dataclasses.dataclass(repr=True, eq=True)
-class TradeSession:
-    users: List[int]
-    items: Dict[int, Dict[str, TradeItem]]
-    id: str
-    is_accepting: bool = False
-    user_accepting: Optional[int] = None
-    accepted: Event = dataclasses.field(default_factory=Event)
-    cancelled: Event = dataclasses.field(default_factory=Event)
+# $1 item id, $2 amount, $3 receiving user id
+_CREDIT_ITEM_QUERY = """
+INSERT INTO inventory (item_id, quantity, user_id) VALUES ($1, $2, $3)
+ON CONFLICT (user_id, item_id) DO UPDATE SET quantity = inventory.quantity + EXCLUDED.quantity
+"""
 
 
 class Trading(commands.Cog):
     def __init__(self, bot: GrowTube) -> None:
-        self.users: Dict[int, TradeSession] = {}
-        self.trades: Dict[str, Tuple[Message, Embed, TradeSession]] = {}
+        self.store = TradeStore(bot.redis, ttl=bot.TRADE_SESSION_TTL)
         self.bot = bot
 
     async def cog_check(self, ctx: GrowContext):
-        if await self.bot.pool.fetchval(
-            "SELECT 1 FROM users WHERE id=$1", ctx.author.id
-        ):
+        if await registered_users.is_registered(self.bot.pool, ctx.author.id):
             return True
-        elif (
-            ctx.author.id not in self.users
-            and self.trades.get(self.users.get(ctx.author.id)) is None
-        ):
-            raise MessagedError("You're not trading with anyone right now")
-        elif self.trades.get(self.users.get(ctx.author.id())) is None:
+        elif not await self.store.is_trading(ctx.author.id):
             raise MessagedError("You're not trading with anyone right now")
         raise MessagedError("You're not registered")
 
-    async def _update_message(self, ctx: GrowContext, session: TradeSession):
-        msg, embed = self.trades[session.id][0:2]
-        index = session.users.index(ctx.author.id)
-        embed.set_field_at(
-            index,
-            name=str(ctx.author),
-            value=", ".join(
-                [
-                    f"{i.amount:,} {currency_name}"
-                    if i.type == 1
-                    else f"{i.amount:,} {i.name}"
-                    for i in session.items[ctx.author.id].values()
-                ]
+    async def _session(self, ctx: GrowContext) -> TradeSession:
+        session = await self.store.of(ctx.author.id)
+        if session is None:
+            raise MessagedError("You're not trading with anyone right now")
+        return session
+
+    def _message(self, session: TradeSession) -> PartialMessage:
+        channel = self.bot.get_partial_messageable(session.channel_id)
+        return channel.get_partial_message(session.message_id)
+
+    def _render(self, session: TradeSession) -> Embed:
+        embed = Embed(title=f"Trade session {session.id}", colour=embed_color)
+        for user_id in session.users:
+            embed.add_field(
+                name=str(self.bot.get_user(user_id)),
+                value=", ".join(
+                    [
+                        f"{i.amount:,} {currency_name}"
+                        if i.type == 1
+                        else f"{i.amount:,} {i.name}"
+                        for i in session.items[user_id].values()
+                    ]
+                )
+                or "No Items",
+            )
+        return embed
+
+    async def _update_message(self, session: TradeSession):
+        await self._message(session).edit(embed=self._render(session))
+
+    async def _complete(self, ctx: GrowContext, session: TradeSession, user2: int):
+        async with user_lock(self.bot, ctx.author.id, user2):
+            market = self.bot.get_cog("Market")
+            if market is not None:
+                await market.collect_buffer.flush_users(
+                    self.bot.pool, [ctx.author.id, user2]
+                )
+            async with self.bot.pool.acquire() as conn:
+                conn: Connection
+                async with conn.transaction():
+                    currency, moves = await self._settle(conn, session)
+        leaderboard.record(self.bot.redis, currency)
+        for user_id, amount in currency.items():
+            ledger.record(
+                ledger_kinds.TRADE,
+                user_id,
+                amount,
+                counterparty=user2 if user_id == ctx.author.id else ctx.author.id,
+            )
+        for user_id, item_id, amount, user_id2 in moves:
+            ledger.record(
+                ledger_kinds.TRADE,
+                user_id,
+                -amount,
+                item_id=item_id,
+                counterparty=user_id2,
+            )
+            ledger.record(
+                ledger_kinds.TRADE,
+                user_id2,
+                amount,
+                item_id=item_id,
+                counterparty=user_id,
             )
-            or "No Items",
+        await self.store.delete(session)
+        await ctx.send(
+            f"{ctx.author} sucessfully traded with {self.bot.get_user(user2)}"
         )
-        await msg.edit(embed=embed)
+
+    async def _settle(
+        self, conn: Connection, session: TradeSession
+    ) -> Tuple[Dict[int, int], List[Tuple[int, int, int, int]]]:
+        """
+        Swaps the items of a trade, must run in a transaction
+
+        The rows of both users are locked and checked again, a user holding
+        less than they offered aborts the trade. Returns the currency change
+        of each user and the item moves as (from, item id, amount, to).
+        """
+        keys = [i for items in session.items.values() for i in items if i is not None]
+        # inventory before users, the same lock order as the market orders
+        held = {
+            (i["user_id"], i["key"]): i
+            for i in await conn.fetch(_LOCK_ITEMS_QUERY, session.users, keys)
+        }
+        balances = dict(await conn.fetch(_LOCK_CURRENCY_QUERY, session.users))
+        currency = {i: 0 for i in session.users}
+        moves = []
+        for user_id in session.users:
+            other = find(lambda user: user != user_id, session.users)
+            for key, item in session.items[user_id].items():
+                if key is None:
+                    if balances.get(user_id, 0) < item.amount:
+                        raise MessagedError(
+                            f"{self.bot.get_user(user_id)} doesn't have {item.amount:,} {currency_name} anymore"
+                        )
+                    currency[user_id] -= item.amount
+                    currency[other] += item.amount
+                    continue
+                row = held.get((user_id, key))
+                if row is None or row["quantity"] < item.amount:
+                    raise MessagedError(
+                        f"{self.bot.get_user(user_id)} doesn't have {item.amount:,} {item.name} anymore"
+                    )
+                moves.append((user_id, row["item_id"], item.amount, other))
+
+        currency = {k: v for k, v in currency.items() if v}
+        if currency:
+            await conn.executemany(
+                "UPDATE users SET currency = currency + $2 WHERE id = $1",
+                sorted(currency.items()),
+            )
+        if moves:
+            await conn.executemany(
+                "UPDATE inventory SET quantity = quantity - $3 WHERE user_id = $1 AND item_id = $2",
+                [i[:3] for i in moves],
+            )
+            await conn.execute(
+                "DELETE FROM inventory WHERE user_id = ANY($1::bigint[]) AND quantity <= 0",
+                session.users,
+            )
+            await conn.executemany(_CREDIT_ITEM_QUERY, [i[1:] for i in moves])
+        return currency, moves
 
     @commands.group(invoke_without_command=True)
     async def trade(self, ctx: GrowContext, user: Optional[User] = None):
@@ -78,13 +180,11 @@ class Trading(commands.Cog):
             return await ctx.send_help(ctx.command)
         elif ctx.author == user:
             raise MessagedError("You can't trade with yourself dummy")
-        elif ctx.author.id in self.users:
+        elif await self.store.is_trading(ctx.author.id):
             raise MessagedError("You're already trading with someone")
-        elif user.id in self.users:
+        elif await self.store.is_trading(user.id):
             raise MessagedError(f"`{user.display_name}` is already trading")
-        elif not await self.bot.pool.fetchval(
-            "SELECT 1 FROM users WHERE id = $1", user.id
-        ):
+        elif not await registered_users.is_registered(self.bot.pool, user.id):
             raise MessagedError("User is not registered")
         else:
             session = TradeSession(
@@ -92,35 +192,34 @@ class Trading(commands.Cog):
                 items={ctx.author.id: {}, user.id: {}},
                 id=token_urlsafe(6),
             )
-            self.users[ctx.author.id] = session
+            if not await self.store.claim(ctx.author.id, session.id):
+                raise MessagedError("You're already trading with someone")
             view = ConfirmView(ctx, responded=user, delete_after=False, timeout=30)
             res = await view.prompt(
                 f"{ctx.author.mention} wants to trade with you {user.mention}"
             )
             if not res:
-                self.users.pop(ctx.author.id)
+                await self.store.release(ctx.author.id)
                 await view.message.reply(f"{user} denied the trade request")
                 return
-            embed = Embed(title=f"Trade session {session.id}", colour=embed_color)
-            for user_id in session.users:
-                embed.add_field(name=str(self.bot.get_user(user_id)), value="No Items")
-            msg = await view.message.reply(embed=embed)
-            self.users[user.id] = session
-            self.trades[session.id] = (msg, embed, session)
+            if not await self.store.claim(user.id, session.id):
+                await self.store.release(ctx.author.id)
+                raise MessagedError(f"`{user.display_name}` is already trading")
+            msg = await view.message.reply(embed=self._render(session))
+            session.channel_id = msg.channel.id
+            session.message_id = msg.id
+            await self.store.save(session)
 
     @trade.command()
     async def cancel(self, ctx: GrowContext):
         """
         Cancels a trade session (only works if in any trade)
         """
-        session = self.users.pop(ctx.author.id)
-        if session.cancelled.is_set():
-            await sleep(0)
-            session.cancelled.set()
-        session.users.remove(ctx.author.id)
-        data = self.trades.pop(session.id)
-        msg, embed, _ = data
-        self.users.pop(session.users[0])
+        session = await self._session(ctx)
+        await self.store.delete(session)
+        await self.store.signal(session.id, CANCEL, ctx.author.id)
+        msg = self._message(session)
+        embed = self._render(session)
         embed.description = "Trade Cancelled"
         await msg.edit(embed=embed)
         await msg.reply("Cancelled trade")
@@ -130,161 +229,55 @@ class Trading(commands.Cog):
         """
         Accepts a trade session, this command waits for the other user to accept
         """
-        session = self.users[ctx.author.id]
-        if session.is_accepting and session.user_accepting == ctx.author.id:
-            return
+        session = await self._session(ctx)
+        if session.user_accepting == ctx.author.id:
+            return await ctx.reply("You already accepted this trade")
         view = ConfirmView(ctx, delete_after=False, timeout=30)
         res = await view.prompt(f"{ctx.author.mention} are you sure you want accept?")
         if res:
-            if session.is_accepting:
-                return session.accepted.set()
-            session.is_accepting = True
-            session.user_accepting = ctx.author.id
             user2: int = find(lambda user: user != ctx.author.id, session.users)
-            create_task(view.message.edit(f"Waiting for {self.bot.get_user(user2)}"))
-            await async_any(
-                session.accepted.wait(),
-                session.cancelled.wait(),
-            )
-            if session.cancelled.is_set():
-                session.is_accepting = False
-                session.user_accepting = None
-                session.accepted.clear()
-                create_task(
-                    view.message.edit(
-                        f"{self.bot.get_user(user2)} cancelled confirmation"
-                    )
-                )
-                return await ctx.reply(
-                    f"{self.bot.get_user(user2)} cancelled the trade confirmation"
-                )
-            else:
-                create_task(view.message.edit(f"{self.bot.get_user(user2)} accepted!"))
-                async with self.bot.pool.acquire() as conn:
-                    conn: Connection
-                    u1_inv = await conn.fetch(
-                        """
-                        SELECT items.name, inventory.item_id, inventory.quantity FROM inventory 
-                        INNER JOIN items ON items.id = inventory.item_id WHERE user_id = $1
-                        """,
-                        ctx.author.id,
-                    )
-                    u2_inv = await conn.fetch(
-                        """
-                        SELECT items.name, inventory.item_id, inventory.quantity FROM inventory 
-                        INNER JOIN items ON items.id = inventory.item_id WHERE user_id = $1
-                        """,
-                        user2,
+            marked = False
+            try:
+                # the other user may be served by another process, their accept
+                # or cancel arrives over the session's channel
+                async with self.store.subscribe(session.id) as pubsub:
+                    marked, accepting = await self.store.begin_accept(
+                        session, ctx.author.id
                     )
-
-                    async with conn.transaction():
-                        items = session.items
-                        incr_updates = []
-                        decr_updates = []
-                        update_currency = []
-                        inserts = []
-                        deletes = []
-                        inv = {
-                            ctx.author.id: {i[0].lower(): i for i in u1_inv},
-                            user2: {i[0].lower(): i for i in u2_inv},
-                        }
-                        if None in items[ctx.author.id] or None in items[user2]:
-                            c1 = items[ctx.author.id].pop(None, None)
-                            c2 = items[user2].pop(None, None)
-                            currencies = await conn.fetch(
-                                "SELECT id, currency FROM users WHERE id in ($1, $2)",
-                                ctx.author.id,
-                                user2,
-                            )
-
-                            if c1 and c2:
-                                cr1 = find(lambda x: x[0] == ctx.author.id, currencies)
-                                cr2 = find(lambda x: x[0] == user2, currencies)
-                                t1 = cr1[1] - c1.amount + c2.amount
-                                t2 = cr2[1] - c2.amount + c1.amount
-                                update_currency.append([t1, ctx.author.id])
-                                update_currency.append([t2, user2])
-                            else:
-                                cr1 = find(lambda x: x[0] == ctx.author.id, currencies)
-                                cr2 = find(lambda x: x[0] == user2, currencies)
-
-                                if c1:
-                                    update_currency.append(
-                                        [cr1[1] - c1.amount, ctx.author.id]
-                                    )
-                                    update_currency.append([cr2[1] + c1.amount, user2])
-                                if c2:
-                                    update_currency.append([cr2[1] - c2.amount, user2])
-                                    update_currency.append(
-                                        [cr1[1] + c2.amount, ctx.author.id]
-                                    )
-
-                        def compute(user_id: int, user_id2: int):
-                            for item in inv[user_id].values():
-                                amount: int = item[2]
-                                item_id: int = item[1]
-                                item = items[user_id].get(item[0].lower())
-                                if item is not None:
-                                    amount_left = amount - item.amount
-                                    if amount_left > 0:
-                                        decr_updates.append(
-                                            [item.amount, item_id, user_id]
-                                        )
-                                    else:
-                                        deletes.append([item_id, user_id])
-
-                                    item_2 = inv[user_id2].get(item.name.lower())
-                                    if item_2 is not None:
-                                        incr_updates.append(
-                                            [item.amount, item_id, user_id2]
-                                        )
-                                    else:
-                                        inserts.append([item_id, user_id2, item.amount])
-
-                        for i in (
-                            [ctx.author.id, user2],
-                            [user2, ctx.author.id],
-                        ):
-                            compute(i[0], i[1])
-
-                        if incr_updates:
-                            await conn.executemany(
-                                "UPDATE inventory SET quantity = quantity + $1 WHERE item_id = $2 and user_id = $3",
-                                incr_updates,
-                            )
-                        if decr_updates:
-                            await conn.executemany(
-                                "UPDATE inventory SET quantity  = quantity - $1 WHERE item_id = $2 and user_id = $3",
-                                decr_updates,
-                            )
-                        if update_currency:
-                            await conn.executemany(
-                                "UPDATE users SET currency = $1 WHERE id = $2",
-                                update_currency,
-                            )
-                        if inserts:
-                            await conn.executemany(
-                                "INSERT INTO inventory (item_id, user_id, quantity) VALUES ($1, $2, $3)",
-                                inserts,
+                    if not marked:
+                        if accepting == ctx.author.id:
+                            return await ctx.reply(
+                                f"You already accepted, waiting for {self.bot.get_user(user2)}"
                             )
-                        if deletes:
-                            await conn.executemany(
-                                "DELETE FROM inventory WHERE item_id = $1 AND user_id = $2",
-                                deletes,
-                            )
-                        await ctx.send(
-                            f"{ctx.author} sucessfully traded with {self.bot.get_user(user2)}"
+                        await self.store.signal(session.id, ACCEPT, ctx.author.id)
+                        return await ctx.reply(
+                            f"Accepted, {self.bot.get_user(user2)} is completing the trade"
+                        )
+                    create_task(
+                        view.message.edit(f"Waiting for {self.bot.get_user(user2)}")
+                    )
+                    signal = await self.store.wait(pubsub, ctx.author.id)
+                if signal == CANCEL:
+                    create_task(
+                        view.message.edit(
+                            f"{self.bot.get_user(user2)} cancelled confirmation"
                         )
-                        self.trades.pop(session.id)
-                        self.users.pop(ctx.author.id)
-                        self.users.pop(user2)
-                        return
+                    )
+                    return await ctx.reply(
+                        f"{self.bot.get_user(user2)} cancelled the trade confirmation"
+                    )
+                create_task(view.message.edit(f"{self.bot.get_user(user2)} accepted!"))
+                stored = await self.store.get(session.id)
+                if stored is None:
+                    raise MessagedError("The trade was cancelled")
+                await self._complete(ctx, stored, user2)
+            finally:
+                # a completed trade is already deleted, anything else must not
+                # leave the session stuck accepting
+                if marked:
+                    await self.store.end_accept(session)
         else:
-            session.is_accepting = False
-            session.accepted.clear()
-            session.cancelled.set()
-            await sleep(0)
-            session.cancelled.clear()
+            await self.store.signal(session.id, CANCEL, ctx.author.id)
             await ctx.reply("Cancelled")
 
     @trade.command()
@@ -296,7 +289,7 @@ class Trading(commands.Cog):
         """
         if amount < 0 or amount == 0:
             return
-        session = self.users[ctx.author.id]
+        session = await self._session(ctx)
         if session.is_accepting:
             return
         if item_name is None:
@@ -305,45 +298,60 @@ class Trading(commands.Cog):
             )
             if currency < amount:
                 return await ctx.reply("You don't have enough {currency_name}")
-            items = self.users[ctx.author.id].items[ctx.author.id]
-            try:
-                item = items[None]
-                if item.amount + amount > currency:
-                    return await ctx.reply(f"You don't have enough {currency_name}")
+            item = session.items[ctx.author.id].get(None)
+            if item is None:
+                item = TradeItem(type=1, amount=amount)
+            elif item.amount + amount > currency:
+                return await ctx.reply(f"You don't have enough {currency_name}")
+            else:
                 item.amount += amount
-            except KeyError:
-                items[None] = TradeItem(type=1, amount=amount)
+            await self.store.set_item(session, ctx.author.id, None, item)
 
-            await self._update_message(ctx, self.users[ctx.author.id])
+            await self._update_message(session)
             return await ctx.reply(f"Added **{amount}** {currency_name}")
         else:
             item_name = item_name.lower()
-            item = await self.bot.pool.fetchrow(
-                """
-                SELECT items.name, inventory.item_id, inventory.quantity FROM inventory
-                INNER JOIN items ON items.id = inventory.item_id
-                WHERE LOWER(items.name) = $1 and inventory.user_id = $2
-                """,
-                item_name,
-                ctx.author.id,
-            )
+            market = self.bot.get_cog("Market")
+            if market is not None:
+                item = None
+                found = market.catalog.find(item_name)
+                if found is not None:
+                    await market.collect_buffer.flush_users(
+                        self.bot.pool, [ctx.author.id]
+                    )
+                    quantity = await self.bot.pool.fetchval(
+                        "SELECT quantity FROM inventory WHERE item_id = $1 AND user_id = $2",
+                        found.id,
+                        ctx.author.id,
+                    )
+                    if quantity is not None:
+                        item = (found.name, found.id, quantity)
+            else:
+                item = await self.bot.pool.fetchrow(
+                    """
+                    SELECT items.name, inventory.item_id, inventory.quantity FROM inventory
+                    INNER JOIN items ON items.id = inventory.item_id
+                    WHERE LOWER(items.name) = $1 and inventory.user_id = $2
+                    """,
+                    item_name,
+                    ctx.author.id,
+                )
             if item is None:
                 return await ctx.reply("You don't have this item")
             if (item[2] - amount) < 0:
                 return await ctx.reply(f"You don't have enough {item[0]}")
             name = item[0]
             real_amount = item[2]
-            try:
-                item = session.items[ctx.author.id][name]
-                if (item.amount + amount) > real_amount:
-                    return await ctx.reply(f"You don't have enough {item[0]}")
+            item = session.items[ctx.author.id].get(name.lower())
+            if item is None:
+                item = TradeItem(type=0, amount=amount, name=name)
+            elif (item.amount + amount) > real_amount:
+                return await ctx.reply(f"You don't have enough {name}")
+            else:
                 item.amount += amount
-            except Exception:
-                session.items[ctx.author.id][item_name] = TradeItem(
-                    type=0, amount=amount, name=name
-                )
+            await self.store.set_item(session, ctx.author.id, name.lower(), item)
 
-            await self._update_message(ctx, self.users[ctx.author.id])
+            await self._update_message(session)
             return await ctx.reply(f"Added **{amount}** {name}")
 
     @trade.command()
@@ -355,37 +363,32 @@ class Trading(commands.Cog):
         """
         if amount < 0 or amount == 0:
             return
-        session = self.users[ctx.author.id]
+        session = await self._session(ctx)
         if session.is_accepting:
             return
         if item_name is None:
-            items = self.users[ctx.author.id].items[ctx.author.id]
-            try:
-                item = items[None]
-                if item.amount - amount < 0:
-                    return await ctx.reply(
-                        f"You don't have {amount} {currency_name} in trade"
-                    )
-                item.amount -= amount
-                if item.amount == 0:
-                    session.items[ctx.author.id].pop(None)
-            except KeyError:
+            item = session.items[ctx.author.id].get(None)
+            if item is None or item.amount - amount < 0:
                 return await ctx.reply(
                     f"You don't have {amount} {currency_name} in trade"
                 )
+            item.amount -= amount
+            await self.store.set_item(
+                session, ctx.author.id, None, item if item.amount else None
+            )
 
-            await self._update_message(ctx, self.users[ctx.author.id])
+            await self._update_message(session)
             return await ctx.reply(f"Removed **{amount}** {currency_name}")
         else:
             item_name = item_name.lower()
-            try:
-                item = session.items[ctx.author.id][item_name]
-                if (item.amount - amount) < 0:
-                    return await ctx.reply(f"You don't have {amount} '{item.name}'")
-                item.amount -= amount
-                if item.amount == 0:
-                    session.items[ctx.author.id].pop(item_name)
-            except Exception:
+            item = session.items[ctx.author.id].get(item_name)
+            if item is None:
                 return await ctx.reply(f"You don't have '{item_name}' in trade")
-            await self._update_message(ctx, self.users[ctx.author.id])
+            if (item.amount - amount) < 0:
+                return await ctx.reply(f"You don't have {amount} '{item.name}'")
+            item.amount -= amount
+            await self.store.set_item(
+                session, ctx.author.id, item_name, item if item.amount else None
+            )
+            await self._update_message(session)
             return await ctx.reply(f"Removed **{amount}** '{item.name}'")
@@ -0,0 +1,227 @@
+from typing import AsyncIterator, Dict, List, Literal, Optional, Tuple
+from contextlib import asynccontextmanager
+from aioredis.client import PubSub
+import aioredis
+import asyncio
+import dataclasses
+
+TRADE_TTL = 900
+
+SESSION_KEY = "trade:session:{}"
+USER_KEY = "trade:user:{}"
+SIGNAL_CHANNEL = "trade:signal:{}"
+
+# signals sent over a session's channel
+ACCEPT = "accept"
+CANCEL = "cancel"
+
+# session fields, every other field is an item "{user id}:{item key}"
+_FIELDS = (b"users", b"channel", b"message", b"accepting")
+
+
+@dataclasses.dataclass(repr=True, eq=True)
+class TradeItem:
+    type: Literal[0, 1] = dataclasses.field(compare=False)  # 0 for item, 1 for currency
+    amount: int = dataclasses.field(compare=False)
+    name: Optional[str] = dataclasses.field(default=None)
+
+
+@dataclasses.dataclass(repr=True, eq=True)
+class TradeSession:
+    users: List[int]
+    # user id -> lowercased item name, None for currency
+    items: Dict[int, Dict[Optional[str], TradeItem]]
+    id: str
+    channel_id: int = 0
+    message_id: int = 0
+    user_accepting: Optional[int] = None
+
+    @property
+    def is_accepting(self) -> bool:
+        return self.user_accepting is not None
+
+
+def _item_field(user_id: int, key: Optional[str]) -> str:
+    return f"{user_id}:{key or ''}"
+
+
+def _encode_item(item: TradeItem) -> str:
+    return f"{item.type}:{item.amount}:{item.name or ''}"
+
+
+def _decode_session(session_id: str, fields: Dict[bytes, bytes]) -> TradeSession:
+    users = [int(i) for i in fields[b"users"].split()]
+    session = TradeSession(
+        users=users,
+        items={i: {} for i in users},
+        id=session_id,
+        channel_id=int(fields[b"channel"]),
+        message_id=int(fields[b"message"]),
+        user_accepting=int(fields[b"accepting"]) if b"accepting" in fields else None,
+    )
+    for field, value in fields.items():
+        if field in _FIELDS:
+            continue
+        user_id, key = field.decode().split(":", 1)
+        type, amount, name = value.decode().split(":", 2)
+        session.items[int(user_id)][key or None] = TradeItem(
+            type=int(type), amount=int(amount), name=name or None
+        )
+    return session
+
+
+class TradeStore:
+    """
+    Trade sessions kept in redis so every process sees the same trades.
+
+    A session is a hash with its users, the id of its message and one field
+    per traded item. Every user in a trade points to its session, both keys
+    expire ``ttl`` seconds after the session was last changed. Accept and
+    cancel signals are published on the session's channel, so the users of a
+    trade can be served by different processes.
+    """
+
+    def __init__(self, redis: aioredis.Redis, *, ttl: int = TRADE_TTL) -> None:
+        self._redis = redis
+        self.ttl = ttl
+
+    async def claim(self, user_id: int, session_id: str) -> bool:
+        """
+        Reserves a user for a session, False if they're already trading
+        """
+        return bool(
+            await self._redis.set(
+                USER_KEY.format(user_id), session_id, nx=True, ex=self.ttl
+            )
+        )
+
+    async def release(self, *user_ids: int) -> None:
+        await self._redis.delete(*(USER_KEY.format(i) for i in user_ids))
+
+    async def is_trading(self, user_id: int) -> bool:
+        return bool(await self._redis.exists(USER_KEY.format(user_id)))
+
+    async def get(self, session_id: str) -> Optional[TradeSession]:
+        fields = await self._redis.hgetall(SESSION_KEY.format(session_id))
+        # a session that expired while someone was accepting only has "accepting"
+        if b"users" not in fields:
+            return None
+        return _decode_session(session_id, fields)
+
+    async def of(self, user_id: int) -> Optional[TradeSession]:
+        """
+        The session a user is trading in, None while it's still being requested
+        """
+        session_id = await self._redis.get(USER_KEY.format(user_id))
+        if session_id is None:
+            return None
+        return await self.get(session_id.decode())
+
+    def _touch(self, pipe, session: TradeSession) -> None:
+        pipe.expire(SESSION_KEY.format(session.id), self.ttl)
+        for user_id in session.users:
+            pipe.set(USER_KEY.format(user_id), session.id, ex=self.ttl)
+
+    async def save(self, session: TradeSession) -> None:
+        key = SESSION_KEY.format(session.id)
+        fields = {
+            "users": " ".join(map(str, session.users)),
+            "channel": session.channel_id,
+            "message": session.message_id,
+        }
+        if session.user_accepting is not None:
+            fields["accepting"] = session.user_accepting
+        for user_id, items in session.items.items():
+            for item_key, item in items.items():
+                fields[_item_field(user_id, item_key)] = _encode_item(item)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=fields)
+            self._touch(pipe, session)
+            await pipe.execute()
+
+    async def delete(self, session: TradeSession) -> None:
+        await self._redis.delete(
+            SESSION_KEY.format(session.id),
+            *(USER_KEY.format(i) for i in session.users),
+        )
+
+    async def set_item(
+        self,
+        session: TradeSession,
+        user_id: int,
+        key: Optional[str],
+        item: Optional[TradeItem],
+    ) -> None:
+        """
+        Writes one item of a user, removes it when ``item`` is None
+
+        Only the item's field is written so both users can change their
+        items at the same time.
+        """
+        field = _item_field(user_id, key)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            if item is None:
+                pipe.hdel(SESSION_KEY.format(session.id), field)
+            else:
+                pipe.hset(SESSION_KEY.format(session.id), field, _encode_item(item))
+            self._touch(pipe, session)
+            await pipe.execute()
+        if item is None:
+            session.items[user_id].pop(key, None)
+        else:
+            session.items[user_id][key] = item
+
+    async def begin_accept(
+        self, session: TradeSession, user_id: int
+    ) -> Tuple[bool, int]:
+        """
+        Marks a user as accepting unless someone already is
+
+        Returns whether the user was marked and the user that is accepting.
+        """
+        key = SESSION_KEY.format(session.id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hsetnx(key, "accepting", user_id)
+            pipe.hget(key, "accepting")
+            pipe.expire(key, self.ttl)
+            marked, accepting, _ = await pipe.execute()
+        session.user_accepting = int(accepting)
+        return bool(marked), session.user_accepting
+
+    async def end_accept(self, session: TradeSession) -> None:
+        await self._redis.hdel(SESSION_KEY.format(session.id), "accepting")
+        session.user_accepting = None
+
+    async def signal(self, session_id: str, signal: str, user_id: int) -> None:
+        await self._redis.publish(
+            SIGNAL_CHANNEL.format(session_id), f"{signal}:{user_id}"
+        )
+
+    @asynccontextmanager
+    async def subscribe(self, session_id: str) -> AsyncIterator[PubSub]:
+        """
+        Listens to a session's signals, subscribe before marking yourself as
+        accepting so the other user's signal can't be missed
+        """
+        async with self._redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+            await pubsub.subscribe(SIGNAL_CHANNEL.format(session_id))
+            yield pubsub
+
+    async def _next_signal(self, pubsub: PubSub, user_id: int) -> str:
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                signal, sender = message["data"].decode().split(":", 1)
+                # an accepting user can still cancel their own trade
+                if signal == CANCEL or int(sender) != user_id:
+                    return signal
+
+    async def wait(self, pubsub: PubSub, user_id: int) -> str:
+        """
+        Waits for an accept of anyone but ``user_id`` or any cancel, a session
+        that expires while waiting counts as cancelled
+        """
+        try:
+            return await asyncio.wait_for(self._next_signal(pubsub, user_id), self.ttl)
+        except asyncio.TimeoutError:
+            return CANCEL
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from time import monotonic
+from bot import GrowContext, MessagedError
+import asyncpg
+
+_REGISTERED = -1.0
+
+
+class RegisteredUsers:
+    """
+    LRU cache of registered users shared by the economy cogs.
+
+    Registrations are permanent so positive entries never expire, negative
+    entries expire after ``negative_ttl`` seconds so a registration made by
+    another process is eventually seen.
+    """
+
+    def __init__(self, maxsize: int = 50000, negative_ttl: float = 60.0) -> None:
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        # user id -> _REGISTERED, or the expiry of a negative entry
+        self._cache: "OrderedDict[int, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _set(self, user_id: int, value: float) -> None:
+        self._cache[user_id] = value
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def add(self, user_id: int) -> None:
+        self._set(user_id, _REGISTERED)
+
+    def discard(self, user_id: int) -> None:
+        self._cache.pop(user_id, None)
+
+    async def is_registered(self, pool: asyncpg.Pool, user_id: int) -> bool:
+        entry = self._cache.get(user_id)
+        if entry == _REGISTERED:
+            self._cache.move_to_end(user_id)
+            return True
+        if entry is not None and entry > monotonic():
+            return False
+        registered = bool(
+            await pool.fetchval("SELECT 1 FROM users WHERE id=$1", user_id)
+        )
+        self._set(
+            user_id, _REGISTERED if registered else monotonic() + self.negative_ttl
+        )
+        return registered
+
+
+registered_users = RegisteredUsers()
+
+
+async def registration_check(ctx: GrowContext) -> bool:
+    if await registered_users.is_registered(ctx.bot.pool, ctx.author.id):
+        return True
+    raise MessagedError("You're not registered")
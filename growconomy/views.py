@@ -1,4 +1,4 @@
-from typing import Any, Optional
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
 from discord import ui
 from discord.ext import commands
 import discord
@@ -63,3 +63,74 @@ class ConfirmView(ui.View):
     @ui.button(label="Deny", style=discord.ButtonStyle.red)
     async def deny(self, button: ui.Button, interaction: discord.Interaction):
         self.result = False
+
+
+class PageView(ui.View):
+    """
+    Pages through results fetched one page at a time.
+
+    ``fetch_page`` takes the cursor of a page (``None`` for the first one) and
+    returns the page content and the cursor of the next page, or ``None`` if
+    it is the last page.
+    """
+
+    def __init__(
+        self,
+        context: commands.Context,
+        fetch_page: Callable[[Any], Awaitable[Tuple[str, Any]]],
+        /,
+        **kwargs: Any,
+    ):
+        super().__init__(**kwargs)
+        self.ctx = context
+        self.fetch_page = fetch_page
+        self.message = None
+        self._cursors: List[Any] = [None]
+        self._next = None
+
+    @property
+    def page(self) -> int:
+        return len(self._cursors)
+
+    async def _load(self) -> str:
+        content, self._next = await self.fetch_page(self._cursors[-1])
+        self.previous.disabled = self.page == 1
+        self.next.disabled = self._next is None
+        return content
+
+    async def start(self) -> None:
+        content = await self._load()
+        if self._next is None:
+            self.message = await self.ctx.reply(content)
+            return super().stop()
+        self.message = await self.ctx.reply(content, view=self)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if self.ctx.author.id != getattr(interaction.user, "id", None):
+            await interaction.response.send_message(
+                f"Only {self.ctx.author} can use this!", ephemeral=True
+            )
+            return False
+        return True
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        await self.message.edit(view=self)
+
+    @ui.button(label="Previous", style=discord.ButtonStyle.blurple)
+    async def previous(self, button: ui.Button, interaction: discord.Interaction):
+        if self.page > 1:
+            self._cursors.pop()
+        await interaction.response.edit_message(content=await self._load(), view=self)
+
+    @ui.button(label="Next", style=discord.ButtonStyle.blurple)
+    async def next(self, button: ui.Button, interaction: discord.Interaction):
+        if self._next is not None:
+            self._cursors.append(self._next)
+        await interaction.response.edit_message(content=await self._load(), view=self)
+
+    @ui.button(label="Close", style=discord.ButtonStyle.grey)
+    async def close(self, button: ui.Button, interaction: discord.Interaction):
+        self.stop()
+        await interaction.response.edit_message(view=None)
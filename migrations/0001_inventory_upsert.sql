@@ -0,0 +1,26 @@
+-- Unique (user_id, item_id) on inventory so buy, sell and collect can upsert,
+-- and the market pricing functions they use.
+BEGIN;
+
+CREATE TEMPORARY TABLE "inventory_merged" ON COMMIT DROP AS
+SELECT "item_id", "user_id", SUM("quantity") AS "quantity" FROM "inventory" GROUP BY "item_id", "user_id";
+
+DELETE FROM "inventory";
+
+INSERT INTO "inventory" ("item_id", "user_id", "quantity") SELECT "item_id", "user_id", "quantity" FROM "inventory_merged";
+
+ALTER TABLE "inventory" ADD CONSTRAINT "inventory_user_id_item_id" UNIQUE ("user_id", "item_id");
+
+-- _calculate_price(value, demand, supply, 0, stock)
+CREATE OR REPLACE FUNCTION market_price("value" BIGINT, "demand" BIGINT, "supply" BIGINT, "stock" BIGINT) RETURNS BIGINT
+LANGUAGE sql IMMUTABLE AS $$
+SELECT CASE WHEN "supply" + "stock" = 0 THEN "value" ELSE trunc("value" * "demand" / ("supply" + "stock")::float8)::bigint END
+$$;
+
+-- compute_transaction(amount)[0]
+CREATE OR REPLACE FUNCTION market_total("amount" BIGINT) RETURNS BIGINT
+LANGUAGE sql IMMUTABLE AS $$
+SELECT trunc("amount" + "amount" * CASE WHEN "amount" > 100000 THEN 0.03 ELSE 0.02 END::float8)::bigint
+$$;
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- OHLC candles written by the market history subscriber.
+-- "resolution" is the candle width and "start" the candle start, both in seconds.
+BEGIN;
+
+CREATE TABLE "price_history" (
+"item_id" BIGINT NOT NULL,
+"resolution" INTEGER NOT NULL,
+"start" BIGINT NOT NULL,
+"open" BIGINT NOT NULL,
+"high" BIGINT NOT NULL,
+"low" BIGINT NOT NULL,
+"close" BIGINT NOT NULL,
+"trades" INTEGER NOT NULL,
+PRIMARY KEY ("item_id", "resolution", "start"));
+
+ALTER TABLE "price_history" ADD CONSTRAINT "price_history_item_id_items_id" FOREIGN KEY ("item_id") REFERENCES "items"("id") ON DELETE CASCADE ON UPDATE NO ACTION;
+
+COMMIT;
@@ -0,0 +1,2 @@
+-- Index for the keyset paginated inventory pages.
+CREATE INDEX "inventory_user_id_quantity_item_id" ON "inventory" ("user_id", "quantity" DESC, "item_id" DESC);
@@ -0,0 +1,25 @@
+-- Economy ledger, existing balances and inventories are recorded as opening entries (kind 0)
+-- dated -infinity so they reconcile with the ledger and stay out of the monthly partitions.
+BEGIN;
+
+-- Append-only record of currency and item movements, "item_id" is NULL for currency.
+-- Monthly partitions are created by the bot, see growconomy/ledger.py
+CREATE TABLE "ledger" (
+"time" TIMESTAMPTZ NOT NULL,
+"kind" SMALLINT NOT NULL,
+"user_id" BIGINT NOT NULL,
+"item_id" BIGINT,
+"amount" BIGINT NOT NULL,
+"counterparty" BIGINT) PARTITION BY RANGE ("time");
+
+CREATE TABLE "ledger_default" PARTITION OF "ledger" DEFAULT;
+
+CREATE INDEX "ledger_user_id_item_id" ON "ledger" ("user_id", "item_id");
+
+INSERT INTO "ledger" ("time", "kind", "user_id", "item_id", "amount")
+SELECT '-infinity', 0, "id", NULL, "currency" FROM "users" WHERE "currency" <> 0;
+
+INSERT INTO "ledger" ("time", "kind", "user_id", "item_id", "amount")
+SELECT '-infinity', 0, "user_id", "item_id", "quantity" FROM "inventory" WHERE "quantity" <> 0;
+
+COMMIT;
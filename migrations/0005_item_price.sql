@@ -0,0 +1,6 @@
+-- Materialized item prices, kept current by postgres on every items update.
+BEGIN;
+
+ALTER TABLE "items" ADD COLUMN "price" BIGINT GENERATED ALWAYS AS (market_price("value", "demand", "supply", "stock")) STORED;
+
+COMMIT;
@@ -11,7 +11,8 @@ CREATE TABLE "items" (
 "value" BIGINT NOT NULL,
 "demand" BIGINT NOT NULL,
 "supply" BIGINT NOT NULL,
-"stock" BIGINT NOT NULL);
+"stock" BIGINT NOT NULL,
+"buyable" BOOLEAN NOT NULL DEFAULT TRUE);
 
 CREATE TABLE "inventory" (
 "item_id" BIGINT NOT NULL,
@@ -37,12 +38,58 @@ CREATE TABLE "positions" (
 "id" BIGINT NOT NULL PRIMARY KEY,
 "duration" BIGINT NOT NULL);
 
+CREATE TABLE "price_history" (
+"item_id" BIGINT NOT NULL,
+"resolution" INTEGER NOT NULL,
+"start" BIGINT NOT NULL,
+"open" BIGINT NOT NULL,
+"high" BIGINT NOT NULL,
+"low" BIGINT NOT NULL,
+"close" BIGINT NOT NULL,
+"trades" INTEGER NOT NULL,
+PRIMARY KEY ("item_id", "resolution", "start"));
+
+-- Append-only record of currency and item movements, "item_id" is NULL for currency.
+-- Monthly partitions are created by the bot, see growconomy/ledger.py
+CREATE TABLE "ledger" (
+"time" TIMESTAMPTZ NOT NULL,
+"kind" SMALLINT NOT NULL,
+"user_id" BIGINT NOT NULL,
+"item_id" BIGINT,
+"amount" BIGINT NOT NULL,
+"counterparty" BIGINT) PARTITION BY RANGE ("time");
+
+CREATE TABLE "ledger_default" PARTITION OF "ledger" DEFAULT;
+
+CREATE INDEX "ledger_user_id_item_id" ON "ledger" ("user_id", "item_id");
+
+ALTER TABLE "inventory" ADD CONSTRAINT "inventory_user_id_item_id" UNIQUE ("user_id", "item_id");
+
+CREATE INDEX "inventory_user_id_quantity_item_id" ON "inventory" ("user_id", "quantity" DESC, "item_id" DESC);
+
 ALTER TABLE "inventory" ADD CONSTRAINT "inventory_item_id_items_id" FOREIGN KEY ("item_id") REFERENCES "items"("id") ON DELETE CASCADE ON UPDATE NO ACTION;
 
 ALTER TABLE "inventory" ADD CONSTRAINT "inventory_user_id_users_id" FOREIGN KEY ("user_id") REFERENCES "users"("id") ON DELETE CASCADE ON UPDATE NO ACTION;
 
+ALTER TABLE "price_history" ADD CONSTRAINT "price_history_item_id_items_id" FOREIGN KEY ("item_id") REFERENCES "items"("id") ON DELETE CASCADE ON UPDATE NO ACTION;
+
 ALTER TABLE "users" ADD CONSTRAINT "users_career_careers_id" FOREIGN KEY ("career") REFERENCES "careers"("id") ON DELETE SET DEFAULT ON UPDATE NO ACTION;
 
 ALTER TABLE "users" ADD CONSTRAINT "users_position_positions_id" FOREIGN KEY ("position") REFERENCES "positions"("id") ON DELETE SET DEFAULT ON UPDATE NO ACTION;
 
-ALTER TABLE "positions" ADD CONSTRAINT "positions_career_careers_id" FOREIGN KEY ("career") REFERENCES "careers"("id") ON DELETE CASCADE ON UPDATE NO ACTION;
\ No newline at end of file
+ALTER TABLE "positions" ADD CONSTRAINT "positions_career_careers_id" FOREIGN KEY ("career") REFERENCES "careers"("id") ON DELETE CASCADE ON UPDATE NO ACTION;
+
+-- _calculate_price(value, demand, supply, 0, stock)
+CREATE FUNCTION market_price("value" BIGINT, "demand" BIGINT, "supply" BIGINT, "stock" BIGINT) RETURNS BIGINT
+LANGUAGE sql IMMUTABLE AS $$
+SELECT CASE WHEN "supply" + "stock" = 0 THEN "value" ELSE trunc("value" * "demand" / ("supply" + "stock")::float8)::bigint END
+$$;
+
+-- compute_transaction(amount)[0]
+CREATE FUNCTION market_total("amount" BIGINT) RETURNS BIGINT
+LANGUAGE sql IMMUTABLE AS $$
+SELECT trunc("amount" + "amount" * CASE WHEN "amount" > 100000 THEN 0.03 ELSE 0.02 END::float8)::bigint
+$$;
+
+-- materialized _calculate_price(value, demand, supply, 0, stock)
+ALTER TABLE "items" ADD COLUMN "price" BIGINT GENERATED ALWAYS AS (market_price("value", "demand", "supply", "stock")) STORED;
@@ -1,11 +1,20 @@
 from typing import (
+    Dict,
     Literal,
     Optional,
     List,
     Tuple,
     Union,
 )
+from secrets import token_hex
+import asyncio
+import logging
 import asyncpg
+import json
+
+CHANNELS_CHANNEL = "channels"
+
+log = logging.getLogger(__name__)
 
 
 class Channel:
@@ -41,47 +50,170 @@ class Channel:
 GuildChannels = Tuple[Optional[Channel], Optional[Channel], Optional[Channel]]
 
 
+def _to_channel(record: asyncpg.Record) -> Channel:
+    return Channel(
+        record["guild"],
+        record["type"],
+        record["channel"],
+        record["webhook"],
+        record["token"],
+    )
+
+
+class ChannelRegistry:
+    """
+    In-memory index of channels, keyed by type, guild and channel id
+    """
+
+    def __init__(self) -> None:
+        self._by_type: Dict[int, Dict[int, Channel]] = {}
+        self._by_guild: Dict[int, Dict[int, Channel]] = {}
+        self._by_channel: Dict[Tuple[int, int], Channel] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_channel)
+
+    def clear(self) -> None:
+        self._by_type.clear()
+        self._by_guild.clear()
+        self._by_channel.clear()
+
+    def add(self, channel: Channel) -> None:
+        self.remove(channel.guild, channel.type)
+        self._by_type.setdefault(channel.type, {})[channel.guild] = channel
+        self._by_guild.setdefault(channel.guild, {})[channel.type] = channel
+        self._by_channel[(channel.channel, channel.type)] = channel
+
+    def remove(self, guild_id: int, channel_type: int) -> Optional[Channel]:
+        channel = self._by_guild.get(guild_id, {}).pop(channel_type, None)
+        if channel is None:
+            return None
+        self._by_type[channel_type].pop(guild_id, None)
+        self._by_channel.pop((channel.channel, channel_type), None)
+        if not self._by_guild[guild_id]:
+            del self._by_guild[guild_id]
+        return channel
+
+    def replace_guild(self, guild_id: int, channels: List[Channel]) -> None:
+        for channel_type in list(self._by_guild.get(guild_id, ())):
+            self.remove(guild_id, channel_type)
+        for channel in channels:
+            self.add(channel)
+
+    def of_type(self, channel_type: int) -> List[Channel]:
+        return list(self._by_type.get(channel_type, {}).values())
+
+    def guild(self, guild_id: int) -> GuildChannels:
+        channels = self._by_guild.get(guild_id, {})
+        return tuple(channels.get(i) for i in range(3))
+
+    def find(self, channel_id: int, channel_type: int) -> Optional[Channel]:
+        return self._by_channel.get((channel_id, channel_type))
+
+
 class PostgresStorage:
-    def __init__(self, pool: asyncpg.Pool):
+    """
+    Channel storage backed by postgres, reads are served from an in-memory
+    :class:`ChannelRegistry` once :meth:`connect` is called.
+
+    Writes go to postgres first and then to the registry, other processes are
+    told to reload the guild through the ``channels`` redis channel.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, redis=None):
         self._pool = pool
+        self._redis = redis
+        self._registry = ChannelRegistry()
+        self._loaded = False
+        self._origin = token_hex(8)
+        self._listener: Optional[asyncio.Task] = None
+
+    @property
+    def registry(self) -> ChannelRegistry:
+        return self._registry
+
+    async def connect(self) -> None:
+        await self.load()
+        if self._redis is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+    async def load(self) -> None:
+        records = await self._pool.fetch("SELECT * FROM channels")
+        self._registry.clear()
+        for record in records:
+            self._registry.add(_to_channel(record))
+        self._loaded = True
+        log.info("Loaded %d channels", len(self._registry))
+
+    async def _reload_guild(self, guild_id: int) -> None:
+        records = await self._pool.fetch(
+            "SELECT * FROM channels WHERE guild = $1", guild_id
+        )
+        self._registry.replace_guild(guild_id, [_to_channel(i) for i in records])
+
+    async def _invalidate(self, guild_id: int) -> None:
+        if self._redis is None:
+            return
+        try:
+            await self._redis.publish(
+                CHANNELS_CHANNEL,
+                json.dumps({"origin": self._origin, "guild": guild_id}),
+            )
+        except Exception:
+            log.exception("Failed to publish channel invalidation")
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self._redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(CHANNELS_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        data = json.loads(message["data"])
+                        if data.get("origin") == self._origin:
+                            continue
+                        if data.get("guild") is None:
+                            await self.load()
+                        else:
+                            await self._reload_guild(data["guild"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Channel invalidation listener failed, reloading")
+                await asyncio.sleep(5)
+                await self.load()
 
     async def get_guild(self, guild_id: int) -> GuildChannels:
+        if self._loaded:
+            return self._registry.guild(guild_id)
         records = await self._pool.fetch(
             "SELECT * FROM channels WHERE guild = $1", guild_id
         )
         channels = {i: None for i in range(3)}
         for record in records:
-            channels[record["type"]] = Channel(
-                record["guild"],
-                record["type"],
-                record["channel"],
-                record["webhook"],
-                record["token"],
-            )
+            channels[record["type"]] = _to_channel(record)
         return tuple(channels.values())
 
     async def get_channel(
         self, channel_id: int, channel_type: int
     ) -> Optional[Channel]:
+        if self._loaded:
+            return self._registry.find(channel_id, channel_type)
         record = await self._pool.fetchrow(
             "SELECT * FROM channels WHERE channel = $1 and type = $2",
             channel_id,
             channel_type,
         )
-        return (
-            Channel(
-                record["guild"],
-                record["type"],
-                record["channel"],
-                record["webhook"],
-                record["token"],
-            )
-            if record is not None
-            else record
-        )
+        return _to_channel(record) if record is not None else record
 
     async def add_channel(self, channel: Channel) -> None:
-        await self._pool.execute(
+        status = await self._pool.execute(
             """
                 INSERT INTO channels (guild, type, channel, webhook, token) SELECT $1,$2,$3,$4,$5 WHERE NOT EXISTS (SELECT 1 FROM channels WHERE guild = $1 AND type = $2)
                 """,
@@ -91,6 +223,9 @@ class PostgresStorage:
             channel.webhook,
             channel.token,
         )
+        if status != "INSERT 0 0":
+            self._registry.add(channel)
+            await self._invalidate(channel.guild)
 
     async def update_channel(self, channel: Channel) -> None:
         await self._pool.execute(
@@ -103,10 +238,15 @@ class PostgresStorage:
             channel.guild,
             channel.type,
         )
+        if self._registry.guild(channel.guild)[channel.type] is not None:
+            self._registry.add(channel)
+        await self._invalidate(channel.guild)
 
     async def get_channels(self, channel_type: int) -> List[Channel]:
+        if self._loaded:
+            return self._registry.of_type(channel_type)
         return [
-            Channel(i["guild"], i["type"], i["channel"], i["webhook"], i["token"])
+            _to_channel(i)
             for i in await self._pool.fetch(
                 "SELECT * FROM channels WHERE type = $1", channel_type
             )
@@ -118,3 +258,26 @@ class PostgresStorage:
             channel.channel,
             channel.type,
         )
+        stored = self._registry.find(channel.channel, channel.type)
+        if stored is not None:
+            self._registry.remove(stored.guild, stored.type)
+        await self._invalidate(channel.guild)
+
+    async def remove_webhook(self, channel: Channel) -> bool:
+        """
+        Removes a channel only while it still uses ``channel``'s webhook, a
+        guild that set up a new webhook in the meantime keeps it
+        """
+        status = await self._pool.execute(
+            "DELETE FROM channels WHERE guild = $1 AND type = $2 AND webhook = $3",
+            channel.guild,
+            channel.type,
+            channel.webhook,
+        )
+        if status == "DELETE 0":
+            return False
+        stored = self._registry.find(channel.channel, channel.type)
+        if stored is not None and stored.webhook == channel.webhook:
+            self._registry.remove(stored.guild, stored.type)
+        await self._invalidate(channel.guild)
+        return True
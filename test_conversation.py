@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+from conversation import ConversationCancelled, ConversationRouter
+import asyncio
+import unittest
+
+
+def _message(channel_id: int, author_id: int, content: str = ""):
+    return SimpleNamespace(
+        channel=SimpleNamespace(id=channel_id),
+        author=SimpleNamespace(id=author_id),
+        content=content,
+    )
+
+
+class ConversationRouterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_dispatch_resolves_matching_prompt(self):
+        router = ConversationRouter()
+        waiter = asyncio.create_task(router.wait(1, 2))
+        await asyncio.sleep(0)
+        await router.dispatch(_message(1, 3, "other author"))
+        await router.dispatch(_message(4, 2, "other channel"))
+        self.assertFalse(waiter.done())
+        message = _message(1, 2, "reply")
+        await router.dispatch(message)
+        self.assertIs(await waiter, message)
+        self.assertEqual(len(router), 0)
+
+    async def test_dispatch_without_prompt_is_ignored(self):
+        router = ConversationRouter()
+        await router.dispatch(_message(1, 2))
+        self.assertEqual(len(router), 0)
+
+    async def test_timeout_removes_prompt(self):
+        router = ConversationRouter()
+        with self.assertRaises(asyncio.TimeoutError):
+            await router.wait(1, 2, timeout=0.01)
+        self.assertNotIn((1, 2), router)
+
+    async def test_cancel(self):
+        router = ConversationRouter()
+        waiter = asyncio.create_task(router.wait(1, 2))
+        await asyncio.sleep(0)
+        self.assertTrue(router.cancel(1, 2))
+        with self.assertRaises(ConversationCancelled):
+            await waiter
+        self.assertFalse(router.cancel(1, 2))
+
+    async def test_waiting_again_replaces_prompt(self):
+        router = ConversationRouter()
+        first = asyncio.create_task(router.wait(1, 2))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(router.wait(1, 2))
+        await asyncio.sleep(0)
+        with self.assertRaises(ConversationCancelled):
+            await first
+        message = _message(1, 2)
+        await router.dispatch(message)
+        self.assertIs(await second, message)
+
+
+if __name__ == "__main__":
+    unittest.main()
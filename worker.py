@@ -0,0 +1,60 @@
+from broadcast import Broadcaster, BroadcastQueue, WebhookJanitor
+import aioredis
+import aiohttp
+import asyncpg
+import asyncio
+import click
+import json
+import logging
+import logs
+import os
+import storage
+
+
+async def _run(dsn: str, redis_url: str, consumer: str):
+    redis = aioredis.from_url(redis_url)
+    pool = await asyncpg.create_pool(dsn)
+    try:
+        async with aiohttp.ClientSession() as session:
+            queue = BroadcastQueue(
+                redis,
+                Broadcaster(session),
+                janitor=WebhookJanitor(redis, storage.PostgresStorage(pool, redis)),
+                consumer=consumer,
+            )
+            await queue.run()
+    finally:
+        await asyncio.gather(pool.close(), redis.close())
+
+
+@click.command()
+@click.option("--use-color", "--use-colour", "-c", type=bool, default=True)
+@click.option("--consumer", "-n", default=None, help="Consumer name in the group")
+def main(use_color: bool, consumer: str):
+    """
+    Delivers queued broadcasts outside of the bot process
+    """
+    config_file = (
+        "config.json" if os.path.isfile("config.json") else "default-config.json"
+    )
+    with open(config_file) as f:
+        config = json.load(f)
+
+    sh = logs.ClickStreamHandler()
+    sh.setFormatter(
+        logs.ColouredFormatter(
+            "[%(levelname)s][%(filename)s] %(message)s", use_colours=use_color
+        )
+    )
+    logging.basicConfig(
+        level=logging.DEBUG if config.get("debug", False) else logging.INFO,
+        handlers=[sh],
+    )
+    try:
+        asyncio.run(_run(config["dsn"], config["redis"], consumer))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()